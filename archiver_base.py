@@ -5,12 +5,185 @@ import pyarrow as pa
 import pyarrow.fs as pafs
 import fsspec
 from pathlib import Path
+from datetime import datetime, timezone
+import inspect
+import os
+import uuid
 import pandas as pd
+import botocore
+import s3fs
+from packaging.version import Version
+import archiver_config as config
+from source_manifest import SourceManifest
+
+# s3fs makes every "xb" upload conditional (If-None-Match) from 2026.9 on, with botocore > 1.35.20
+# (earlier releases only did so for multipart uploads); older stacks check for the object first
+S3_EXCLUSIVE_CREATE = (Version(s3fs.__version__) >= Version("2026.9.0")
+                       and Version(botocore.__version__) > Version("1.35.20"))
+
+# bloom filters need pyarrow >= 24 (pinned in requirements.txt); older writers skip them
+BLOOM_FILTERS_SUPPORTED = "bloom_filter_options" in inspect.signature(pq.ParquetWriter.__init__).parameters
+
+def archive_dataset_path(path):
+    """
+    Dataset directory (or S3 prefix) that holds the part files of a monthly archive:
+    2025_01_archive.parquet -> 2025_01_archive/. A legacy single-file archive at path
+    itself is still part of the month.
+    """
+    path = str(path)
+    return path[:-len(".parquet")] if path.endswith(".parquet") else path
+
+def new_part_name():
+    """Unique, time-ordered part file name: part-<UTC stamp>-<uuid>.parquet"""
+    return f"part-{datetime.now(timezone.utc):%Y%m%dT%H%M%S%fZ}-{uuid.uuid4().hex[:12]}.parquet"
+
+def list_archive_files(fs, path):
+    """
+    Every Parquet file making up the monthly archive at path on an fsspec filesystem.
+
+    Returns:
+    - list[str] — the legacy monthly file (if present) followed by the part files, oldest first
+    """
+    files = [path] if fs.isfile(path) else []
+    return files + sorted(fs.glob(f"{archive_dataset_path(path)}/part-*.parquet"))
+
+def archive_keys(columns, keys=None):
+    """
+    De-duplication keys and sort order for an archive with these columns.
+
+    Returns:
+    - list[str] — de-duplication keys (first ARCHIVE_KEYS entry present in columns), None if none match
+    - list[str] — sort columns: station, valid_time (when present), the remaining keys
+    """
+    columns = list(columns)
+    if keys is None:
+        keys = next((k for k in config.ARCHIVE_KEYS if all(c in columns for c in k)), None)
+        if keys is None:
+            return None, []
+    sort_cols = [keys[0]] + (["valid_time"] if "valid_time" in columns else [])
+    return keys, sort_cols + [k for k in keys[1:] if k not in sort_cols]
+
+def archive_sort_key(column):
+    """
+    sort_values key ordering categorical columns (dictionary-typed station ids read back
+    from Parquet) by their string values, as Parquet statistics do, not by category code.
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.astype(str)
+    return column
+
+def sort_archive_frame(df, sort_cols=None):
+    """Rows clustered by station, then time, so each row group covers a few stations."""
+    if sort_cols is None:
+        _, sort_cols = archive_keys(df.columns)
+    if not sort_cols:
+        return df
+    return df.sort_values(sort_cols, kind="stable", ignore_index=True, key=archive_sort_key)
+
+def archive_write_options(columns, keys=None):
+    """
+    pyarrow Parquet writer options for archive files: min/max statistics and page indexes
+    for predicate pushdown, the station/time sort order recorded in the metadata, and a
+    bloom filter on the station column when ARCHIVE_BLOOM_FILTERS is set.
+    """
+    columns = list(columns)
+    keys, sort_cols = archive_keys(columns, keys)
+    options = {
+        "write_statistics": True,
+        "write_page_index": True,
+        "sorting_columns": [pq.SortingColumn(columns.index(c)) for c in sort_cols],
+    }
+    if keys and config.ARCHIVE_BLOOM_FILTERS and BLOOM_FILTERS_SUPPORTED:
+        options["bloom_filter_options"] = {keys[0]: {"ndv": config.ARCHIVE_BLOOM_FILTER_NDV, "fpp": 0.05}}
+    return options
+
+STATION_TYPE = pa.dictionary(pa.int32(), pa.string())
+
+TIME_TYPE = pa.timestamp("s", tz="UTC")
+# Arrow types of the archive columns. Float columns not listed here are stored as float32
+# (about 7 significant digits, see archive_schema); values are not rounded here.
+ARCHIVE_COLUMN_TYPES = {
+    # repeated labels
+    "station_id": STATION_TYPE,
+    "stid": STATION_TYPE,
+    "NWSZONE": STATION_TYPE,
+    "NWSCWA": STATION_TYPE,
+    "precip_units": STATION_TYPE,
+    "temp_units": STATION_TYPE,
+    # times (naive times are UTC)
+    "init_time": TIME_TYPE,
+    "valid_time": TIME_TYPE,
+    "start_time": TIME_TYPE,
+    "end_time": TIME_TYPE,
+    "date": TIME_TYPE,
+    "window_start": TIME_TYPE,
+    "window_end": TIME_TYPE,
+    # small integers
+    "forecast_hour": pa.int16(),
+    "accum_hours": pa.int16(),
+    "step_hours": pa.int16(),
+    # station location (obs archives carry it as strings, "" when unknown; stored as numbers or null)
+    "lat": pa.float64(),
+    "lon": pa.float64(),
+    "elev": pa.float32(),
+}
+
+def archive_schema(schema):
+    """
+    Explicit archive schema for a table's columns: ARCHIVE_COLUMN_TYPES where listed,
+    otherwise float32 values, timestamp[s, UTC] times, int32 integers and plain strings.
+    Each element's archive gets the schema of the columns it writes.
+    """
+    fields = []
+    for field in schema:
+        if field.name in ARCHIVE_COLUMN_TYPES:
+            type_ = ARCHIVE_COLUMN_TYPES[field.name]
+        elif pa.types.is_floating(field.type):
+            type_ = pa.float32()
+        elif pa.types.is_timestamp(field.type):
+            type_ = TIME_TYPE
+        elif pa.types.is_integer(field.type):
+            type_ = pa.int32()
+        elif pa.types.is_large_string(field.type):
+            type_ = pa.string()
+        else:
+            type_ = field.type
+        fields.append(pa.field(field.name, type_))
+    return pa.schema(fields)
+
+def cast_archive_column(values, type_):
+    """
+    Cast one column to its archive type. Timestamps drop sub-second precision, text in float
+    columns becomes null where it is not a number, other casts are checked.
+    """
+    if pa.types.is_floating(type_) and (pa.types.is_string(values.type) or pa.types.is_large_string(values.type)):
+        return pa.array(pd.to_numeric(values.to_pandas(), errors="coerce"), type=type_, from_pandas=True)
+    return values.cast(type_, safe=not pa.types.is_timestamp(type_))
+
+def archive_table(df):
+    """
+    DataFrame -> Arrow table with the archive schema.
+
+    Returns:
+    - pa.Table
+    """
+    # numeric columns held as text (obs lat/lon/elev from Synoptic), with "" or junk as NaN
+    text = [c for c, t in ARCHIVE_COLUMN_TYPES.items()
+            if pa.types.is_floating(t) and c in df.columns and not pd.api.types.is_numeric_dtype(df[c])]
+    if text:
+        df = df.assign(**{c: pd.to_numeric(df[c], errors="coerce") for c in text})
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    schema = archive_schema(table.schema)
+    return pa.table([cast_archive_column(table.column(f.name), f.type) for f in schema], schema=schema)
 
 class Archiver(ABC):
     def __init__(self, config):
         self.config = config
         self.station_index_cache = {}
+        self.manifest = SourceManifest() if config.USE_SOURCE_MANIFEST else None
+        # {source: {"etag", "size"}} from discovery, {source: rows} from the last process_files
+        self.source_info = {}
+        self.source_rows = {}
 
     @abstractmethod
     def fetch_file_list(self, start, end):
@@ -38,60 +211,88 @@ class Archiver(ABC):
 
 
     def write_to_s3(self, df, s3_path, profile="default", region="us-east-2"):
+        """
+        Add df to the monthly archive at s3_path as a new immutable part file under its
+        dataset prefix (see archive_dataset_path). The put is conditional (If-None-Match)
+        where s3fs supports it (S3_EXCLUSIVE_CREATE), otherwise preceded by an existence
+        check, so an existing object is not overwritten; nothing already archived is read.
+
+        Returns:
+        - str or None — the part written, None when nothing was written
+        """
         try:
+            if df.empty:
+                print(f"ℹ️ No rows to write for {s3_path}")
+                return None
             fs = fsspec.filesystem("s3", profile=profile, client_kwargs={"region_name": region})
-            
-            if fs.exists(s3_path):
-                print(f"ℹ️ File exists at {s3_path}, appending to it...")
-                with fs.open(s3_path, "rb") as f:
-                    existing_df = pd.read_parquet(f)
+            part_path = f"{archive_dataset_path(s3_path)}/{new_part_name()}"
+            table = archive_table(sort_archive_frame(df.drop_duplicates()))
+            if not S3_EXCLUSIVE_CREATE and fs.exists(part_path):
+                raise FileExistsError(f"{part_path} already exists")
+            with fs.open(part_path, "xb" if S3_EXCLUSIVE_CREATE else "wb") as f:
+                pq.write_table(table, f, row_group_size=config.ARCHIVE_ROW_GROUP_SIZE,
+                               **archive_write_options(table.schema.names))
 
-                # Concatenate and drop duplicates if needed (optional)
-                combined_df = pd.concat([existing_df, df], ignore_index=True).drop_duplicates()
-
-                with fs.open(s3_path, "wb") as f:
-                    combined_df.to_parquet(f, index=False)
-            else:
-                print(f"ℹ️ File does not exist at {s3_path}, creating new file...")
-                with fs.open(s3_path, "wb") as f:
-                    df.to_parquet(f, index=False)
+            print(f"✅ Successfully wrote {table.num_rows} rows to {part_path}")
+            return part_path
 
-            print(f"✅ Successfully wrote to {s3_path}")
-            
         except Exception as e:
             print(f"❌ Failed to write to S3: {e}")
+            return None
 
 
     def write_local_output(self, df, local_path, dedup_columns=None):
         """
-        Save DataFrame locally to a Parquet file. If the file exists, append and de-duplicate.
-        
+        Save DataFrame locally as a new part file of the monthly archive at local_path.
+        The part is written under a temporary name and renamed into place, so readers
+        never see a partial file; existing data is not read or rewritten.
+
         Parameters:
             df (pd.DataFrame): DataFrame to write
-            local_path (str or Path): Path to local Parquet file
-            dedup_columns (list or None): Columns to use for de-duplication. If None, all columns used.
+            local_path (str or Path): Path of the monthly Parquet archive
+            dedup_columns (list or None): Columns to use for de-duplicating df. If None, all columns used.
+
+        Returns:
+            str or None: the part written, None when nothing was written
         """
         try:
-            local_path = Path(local_path)
-            local_path.parent.mkdir(parents=True, exist_ok=True)
-
-            if local_path.exists():
-                print(f"ℹ️ File exists at {local_path}, appending and de-duplicating...")
-                existing_df = pd.read_parquet(local_path)
-                combined_df = pd.concat([existing_df, df], ignore_index=True)
-                if dedup_columns:
-                    combined_df = combined_df.drop_duplicates(subset=dedup_columns)
-                else:
-                    combined_df = combined_df.drop_duplicates()
-            else:
-                print(f"ℹ️ Creating new file at {local_path}...")
-                combined_df = df
+            if df.empty:
+                print(f"ℹ️ No rows to write for {local_path}")
+                return None
+            dataset_dir = Path(archive_dataset_path(local_path))
+            dataset_dir.mkdir(parents=True, exist_ok=True)
+            part_path = dataset_dir / new_part_name()
+            tmp_path = dataset_dir / f".{part_path.name}.tmp"
+
+            table = archive_table(sort_archive_frame(df.drop_duplicates(subset=dedup_columns)))
+            pq.write_table(table, tmp_path, row_group_size=config.ARCHIVE_ROW_GROUP_SIZE,
+                           **archive_write_options(table.schema.names))
+            os.replace(tmp_path, part_path)
+            print(f"📁 Saved {table.num_rows} rows locally: {part_path}")
+            return str(part_path)
 
-            combined_df.to_parquet(local_path, index=False)
-            print(f"📁 Saved locally: {local_path}")
-            
         except Exception as e:
             print(f"❌ Failed to write local file: {local_path} — {e}")
+            return None
+
+    def filter_new_sources(self, archive_path, sources):
+        """
+        Drop the sources already written to the monthly archive at archive_path (see
+        SourceManifest); a no-op without the manifest or with REPROCESS_SOURCES.
+        """
+        if self.manifest is None or self.config.REPROCESS_SOURCES:
+            return list(sources)
+        new = self.manifest.unseen(str(archive_path), sources, self.source_info)
+        if len(new) < len(sources):
+            print(f"ℹ️ Skipping {len(sources) - len(new)} source files already in {archive_path} ({len(new)} new)")
+        return new
+
+    def mark_processed(self, archive_path):
+        """Record the sources of the last process_files as written to archive_path."""
+        if self.manifest is None or not self.source_rows:
+            return
+        self.manifest.record(str(archive_path), self.source_rows, self.source_info)
+        print(f"🗂️ Recorded {len(self.source_rows)} processed source files for {archive_path}")
 
     def append_to_parquet_s3(self, df_new, s3_path, unique_keys):
         try:
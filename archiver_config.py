@@ -14,8 +14,12 @@ OBS = os.path.join(HOME, 'obs')
 MODEL_DIR = os.path.join(HOME, 'model')
 
 TMP = os.path.join(HOME, 'tmp_cache')
+# persistent across runs (TMP is wiped after every chunk)
+IDX_CACHE_DIR = os.path.join(HOME, 'idx_cache')
 
-for directory in [OBS, MODEL_DIR, TMP]:
+GRID_INDEX_DIR = os.path.join(HOME, 'grid_index')
+
+for directory in [OBS, MODEL_DIR, TMP, IDX_CACHE_DIR, GRID_INDEX_DIR]:
     os.makedirs(directory, exist_ok=True)
 ######################## File Names #################################
 
@@ -155,7 +159,7 @@ HERBIE_XARRAY_STRINGS = {'Wind': {'nbm': [':WIND:10 m above', ':WDIR:10 m above'
                                   'nbm_exp': [':WIND:10 m above', ':WDIR:10 m above', ':GUST:10 m above'],
                                   'nbmqmd_exp': [':WIND:10 m above'],
 								   'hrrr': [':UGRD:10 m above',':VGRD:10 m above',':GUST:surface'],
-                                   'urma': []},
+                                   'urma': [':WIND:10 m above', ':WDIR:10 m above', ':GUST:10 m above']},
                         'precip24hr': {'nbmqmd': [':APCP:surface:'],
                                        'nbmqmd_exp': [':APCP:surface:']},
                         'precip6hr': {'nbmqmd': [':APCP:surface:'],
@@ -213,7 +217,7 @@ QMD_CYCLES = {
 }
 
 HERBIE_REQUIRED_PHRASES = {'Wind': {'nbm': ['10 m above ground'], 'hrrr': ['10 m above ground'],
-                                    'nbm_exp': ['10 m above ground']},
+                                    'nbm_exp': ['10 m above ground'], 'urma': ['10 m above ground']},
                            'precip24hr': {'nbmqmd': ['APCP:surface']},
                            'precip6hr': {'nbmqmd': ['APCP:surface'], 'hrrr': ['APCP:surface']},
                            'snow6hr': {'nbm': ['ASNOW:surface'], 'nbm_exp': ['ASNOW:surface'], 'hrrr': ['ASNOW:surface']},
@@ -223,7 +227,7 @@ HERBIE_REQUIRED_PHRASES = {'Wind': {'nbm': ['10 m above ground'], 'hrrr': ['10 m
                            'maxt': {'nbmqmd': [':TMP:2 m above ground:']},
                            'mint': {'nbmqmd': [':TMP:2 m above ground:']}}
 
-HERBIE_EXCLUDE_PHRASES = {'Wind': {'nbm': ['ens std dev'], 'nbm_exp': ['ens std dev'], 'hrrr': ['ens std dev']},
+HERBIE_EXCLUDE_PHRASES = {'Wind': {'nbm': ['ens std dev'], 'nbm_exp': ['ens std dev'], 'hrrr': ['ens std dev'], 'urma': []},
                           'precip24hr': {'nbmqmd': ['ens std dev']},
                           'precip6hr': {'nbmqmd': ['ens std dev'], 'hrrr': ['ens std dev']},
                           'snow6hr': {'nbm': ['prob'], 'nbm_exp': ['prob'], 'hrrr': ['ens std dev']},
@@ -469,6 +473,9 @@ NDFD_FILE_STRINGS = {"Wind":["wspd", "wdir"],
                     "snow6hr": ["snow"]
                     }
 
+# component files issued further apart than this are not paired (e.g. wspd with wdir)
+NDFD_PAIR_TOLERANCE = "2 minutes"
+
 NDFD_ELEMENT_STRINGS = {"Wind": ["si10", "wdir10"],
                         "Gust": ["i10fg"],
                         "precip6hr": ["unknown"],
@@ -506,4 +513,95 @@ MODEL_URLS = {'nbm': "https://noaa-nbm-grib2-pds.s3.amazonaws.com",
 
 #################### Processing Params ########################
 # for process pool operations
-MAX_WORKERS = 4
\ No newline at end of file
+MAX_WORKERS = 4
+# NDFD file pairs decoded at once; each holds one 2D field at a time, so this can exceed MAX_WORKERS
+NDFD_MAX_WORKERS = 8
+#################### Network Params ###########################
+# keep-alive pool shared by discovery and downloads
+HTTP_POOL_CONNECTIONS = 8
+
+HTTP_POOL_MAXSIZE = 64
+# concurrent .idx availability probes (and per bucket host)
+DISCOVERY_WORKERS = 32
+
+DISCOVERY_PER_HOST = 16
+
+DISCOVERY_TIMEOUT = 5
+# "head" probes every expected .idx, "list" lists each cycle prefix once (S3 ListObjectsV2)
+DISCOVERY_MODE = "head"
+
+S3_LIST_MAX_KEYS = 1000
+# .idx text cache shared by discovery and download_subset
+USE_IDX_CACHE = True
+# cycles older than this never expire; younger cycles are re-fetched after the TTL
+IDX_CACHE_RECENT_HOURS = 48
+
+IDX_CACHE_TTL_MINUTES = 60
+# GRIB messages closer than this many bytes are fetched in one range request
+RANGE_MERGE_GAP = 512 * 1024
+# concurrent range requests per file
+RANGE_FETCH_WORKERS = 4
+# downloads are streamed to disk in chunks of this size
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# also MD5-check whole-file downloads against single-part S3 ETags (byte counts are always checked)
+VERIFY_CHECKSUMS = False
+# decode byte-range subsets from memory (eccodes/pygrib) instead of writing temp GRIB files
+IN_MEMORY_DECODE = False
+# "threads" (ThreadPoolExecutor, MAX_WORKERS files at a time) or "async" (aiohttp engine below)
+DOWNLOAD_ENGINE = "threads"
+# async engine: requests in flight overall and per bucket host
+ASYNC_MAX_CONCURRENCY = 128
+
+ASYNC_PER_HOST = 64
+# seconds to connect / between bytes before a request is retried
+ASYNC_TIMEOUT = 30
+# downloaded files waiting to be decoded; downloaders block when it is full, bounding temp disk
+PIPELINE_QUEUE_SIZE = 8
+# files the async engine downloads at once (each may hold several range requests)
+ASYNC_MAX_FILES = 32
+# download the whole URMA analysis when its .idx is missing or lacks the requested fields
+URMA_FULL_FILE_FALLBACK = True
+# station -> grid point indices saved per (grid definition, station list) and reused across runs
+USE_GRID_INDEX_STORE = True
+# stations farther than this many grid spacings from their nearest point are flagged out of domain
+GRID_INDEX_OUT_OF_DOMAIN_FACTOR = 1.5
+# station -> grid point lookup: "projection" (from the GRIB grid definition, falls back to
+# "kdtree" for unsupported grids), "kdtree" (3D KD-tree over lat/lon) or "chebyshev" (ll_to_index)
+GRID_LOOKUP = "projection"
+# model decode/extract processes; None = every core available to the run, 1 = decode in the pipeline thread
+DECODE_WORKERS = None
+# point value operator per element, e.g. {"Gust": "max", "snow6hr": "max"}: "nearest" (default),
+# "bilinear" or "idw" over the surrounding 2x2 cell, "mean" or "max" over the neighborhood block;
+# wind directions always use the nearest grid point
+POINT_OPERATORS = {}
+# neighborhood block for "mean"/"max": (2 * NEIGHBORHOOD_HALF_WIDTH + 1) grid points on a side
+NEIGHBORHOOD_HALF_WIDTH = 1
+# deterministic model files: "eccodes" walks the GRIB messages directly (read_grib_fields),
+# "cfgrib" opens them with xarray; in-memory subsets always use eccodes
+GRIB_READER = "eccodes"
+# archive de-duplication keys for compact_archives.py: the first entry whose columns all exist in
+# the month; compacted files are sorted by its station column, then valid_time, then the other keys
+ARCHIVE_KEYS = [
+    ["station_id", "init_time", "forecast_hour"],   # model forecasts
+    ["station_id", "valid_time", "forecast_hour"],  # NDFD (no init_time column)
+    ["stid", "end_time", "accum_hours"],            # obs precip
+    ["stid", "date"],                               # obs maxt/mint
+    ["stid", "valid_time"],                         # obs wind
+]
+# rows per row group in archive part and compacted files; rows are sorted by station, so a
+# row group covers a few stations and single-station reads skip the rest via min/max statistics
+ARCHIVE_ROW_GROUP_SIZE = 64 * 1024
+# bloom filter on the station column of every row group (written with pyarrow >= 24)
+ARCHIVE_BLOOM_FILTERS = True
+# distinct stations expected per row group, sizes the bloom filter
+ARCHIVE_BLOOM_FILTER_NDV = 2048
+# compaction sorts/de-duplicates one station range of at most this many rows at a time
+COMPACT_MAX_ROWS_IN_MEMORY = 4_000_000
+# a compacted month rolls over to a new file after this many rows
+COMPACT_MAX_FILE_ROWS = 50_000_000
+# record processed source files per monthly archive (SQLite) so runs only fetch sources not yet archived there
+USE_SOURCE_MANIFEST = True
+# shared by every archiver run on this machine
+SOURCE_MANIFEST_PATH = os.path.join(HOME, 'source_manifest.sqlite')
+# process every listed source again (results are still recorded in the manifest)
+REPROCESS_SOURCES = False
@@ -0,0 +1,104 @@
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import xarray as xr
+import eccodes
+import utils
+
+# Compares the two deterministic GRIB readers used by extract_model_subset_parallel:
+# cfgrib (xr.open_dataset + values + lat/lon, the GRIB_READER="cfgrib" path) and the
+# direct eccodes message walk (utils.read_grib_fields, GRIB_READER="eccodes").
+#
+#   python benchmark_grib_readers.py blend.t00z.core.f001.ak.grib2 blend.t00z.core.f002.ak.grib2
+#   python benchmark_grib_readers.py --synthetic 1649x1105 --files 20
+
+def read_cfgrib(path, filter_keys=None):
+    backend_kwargs = {"indexpath": "", "errors": "ignore", "read_keys": list(utils.GRID_DEFINITION_KEYS)}
+    if filter_keys:
+        backend_kwargs["filter_by_keys"] = filter_keys
+    ds = xr.open_dataset(path, engine="cfgrib", backend_kwargs=backend_kwargs, decode_timedelta=True)
+    fields = {name: ds[name].values for name in ds.data_vars}
+    lats, lons = ds.latitude.values, ds.longitude.values
+    ds.close()
+    return fields, lats, lons
+
+def read_eccodes(path, filter_keys=None):
+    grib = utils.read_grib_fields(path, filter_keys=filter_keys)
+    return grib["fields"], grib["lats"], grib["lons"]
+
+def write_synthetic_files(out_dir, nx, ny, n_files):
+    """NBM-like polar stereographic files with 10 m wind speed, direction and gust."""
+    rng = np.random.default_rng(0)
+    paths = []
+    for n in range(n_files):
+        messages = []
+        for param in (207, 3031, 228029):  # si10, wdir10, i10fg
+            gid = eccodes.codes_grib_new_from_samples("GRIB2")
+            eccodes.codes_set(gid, "gridDefinitionTemplateNumber", 20)
+            for key, value in [("Nx", nx), ("Ny", ny), ("latitudeOfFirstGridPointInDegrees", 40.5),
+                               ("longitudeOfFirstGridPointInDegrees", 181.4), ("LaDInDegrees", 60),
+                               ("orientationOfTheGridInDegrees", 210), ("DxInMetres", 2976.56),
+                               ("DyInMetres", 2976.56), ("jScansPositively", 1),
+                               ("typeOfFirstFixedSurface", 103), ("scaledValueOfFirstFixedSurface", 10),
+                               ("paramId", param), ("forecastTime", n + 1), ("bitsPerValue", 12)]:
+                eccodes.codes_set(gid, key, value)
+            eccodes.codes_set_values(gid, rng.uniform(0, 30, nx * ny))
+            messages.append(eccodes.codes_get_message(gid))
+            eccodes.codes_release(gid)
+        path = os.path.join(out_dir, f"synthetic.f{n + 1:03d}.grib2")
+        with open(path, "wb") as f:
+            f.write(b"".join(messages))
+        paths.append(path)
+    return paths
+
+def time_reader(reader, paths, repeat, filter_keys=None):
+    """Seconds per file for each pass over all paths."""
+    per_file = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for path in paths:
+            reader(path, filter_keys)
+        per_file.append((time.perf_counter() - start) / len(paths))
+    return np.array(per_file)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cfgrib vs direct eccodes GRIB decoding")
+    parser.add_argument("files", nargs="*", help="GRIB2 subset files to decode")
+    parser.add_argument("--repeat", type=int, default=3, help="Passes over the file list per reader")
+    parser.add_argument("--urma", action="store_true", help="Apply the URMA 10 m filter keys")
+    parser.add_argument("--synthetic", help="Generate NXxNY synthetic files instead (e.g. 1649x1105)")
+    parser.add_argument("--files", dest="n_files", type=int, default=10, help="Number of synthetic files")
+    args = parser.parse_args()
+
+    filter_keys = utils.URMA_FILTER_KEYS if args.urma else None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.synthetic:
+            nx, ny = (int(v) for v in args.synthetic.lower().split("x"))
+            print(f"🧪 Writing {args.n_files} synthetic {nx}x{ny} files...")
+            paths = write_synthetic_files(tmp_dir, nx, ny, args.n_files)
+        else:
+            paths = args.files
+        if not paths:
+            parser.error("pass GRIB files or --synthetic NXxNY")
+
+        cf_fields, _, _ = read_cfgrib(paths[0], filter_keys)
+        ec_fields, _, _ = read_eccodes(paths[0], filter_keys)
+        for name in sorted(set(cf_fields) | set(ec_fields)):
+            if name not in cf_fields or name not in ec_fields:
+                print(f"⚠️ {name} only decoded by {'eccodes' if name in ec_fields else 'cfgrib'}")
+            elif not np.array_equal(cf_fields[name], ec_fields[name], equal_nan=True):
+                print(f"❌ {name} differs between readers")
+
+        print(f"⏱️ {len(paths)} files x {args.repeat} passes")
+        results = {
+            "cfgrib": time_reader(read_cfgrib, paths, args.repeat, filter_keys),
+            "eccodes": time_reader(read_eccodes, paths, args.repeat, filter_keys),
+        }
+        for name, per_file in results.items():
+            print(f"   {name:8s} {per_file.mean() * 1000:9.1f} ms/file (best pass {per_file.min() * 1000:.1f})")
+        print(f"✅ eccodes is {results['cfgrib'].min() / results['eccodes'].min():.1f}x faster per file")
+
+if __name__ == "__main__":
+    main()
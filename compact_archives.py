@@ -0,0 +1,233 @@
+import argparse
+import os
+import tempfile
+from collections import Counter
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import fsspec
+import archiver_config as config
+from archiver_base import (archive_dataset_path, archive_keys, archive_schema, archive_write_options,
+                           cast_archive_column, list_archive_files, sort_archive_frame)
+
+# Merges the part files of monthly archives (see Archiver.write_local_output / write_to_s3)
+# into a few large files, de-duplicated on ARCHIVE_KEYS and sorted by station and time.
+# Only the files present when a month's compaction starts are merged and then removed, so
+# archivers can keep adding parts while it runs (don't run two compactions of one month at once).
+#
+#   python compact_archives.py model/nbm/wind/2025_01_archive.parquet
+#   python compact_archives.py --all model ndfd obs
+#   python compact_archives.py s3://alaska-verification/ndfd/2025_01_ndfd_wind_archive.parquet
+
+def get_fs(path, profile=None):
+    if path.startswith("s3://"):
+        return fsspec.filesystem("s3", profile=profile or "default", client_kwargs={"region_name": "us-east-2"})
+    return fsspec.filesystem("file")
+
+def find_monthly_archives(fs, root):
+    """Monthly archive paths (…_archive.parquet) under root, whether legacy files or part datasets."""
+    root = root.rstrip("/")
+    months = set(fs.glob(f"{root}/**/*_archive.parquet"))
+    months |= {f"{os.path.dirname(p)}.parquet" for p in fs.glob(f"{root}/**/*_archive/part-*.parquet")}
+    prefix = "s3://" if root.startswith("s3://") else ""
+    return sorted(p if p.startswith(prefix) else f"{prefix}{p}" for p in months)
+
+def compacted_part_name(newest, n):
+    """
+    Name of the n-th compacted file replacing a month's files up to newest (its newest part):
+    that part's name with a _c<n> suffix. It sorts right after every input ("_" > ".") and
+    before any part written later (later stamp), so newer parts still win de-duplication.
+    """
+    return f"{os.path.basename(newest)[:-len('.parquet')]}_c{n:03d}.parquet"
+
+def month_schema(schemas):
+    """Archive schema over every column of a month's files (older parts may predate a column or the archive types)."""
+    fields = {}
+    for schema in schemas:
+        for field in schema:
+            if field.name not in fields or pa.types.is_null(fields[field.name].type):
+                fields[field.name] = field
+    return archive_schema(pa.schema(list(fields.values())))
+
+def align_batch(batch, schema):
+    """Cast a record batch to the month's schema, adding null columns it lacks."""
+    columns = []
+    for field in schema:
+        if field.name in batch.schema.names:
+            columns.append(cast_archive_column(batch.column(field.name), field.type))
+        else:
+            columns.append(pa.nulls(batch.num_rows, type=field.type))
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+def station_buckets(fs, files, station_col, max_rows):
+    """
+    Split the sorted station ids into contiguous ranges of at most max_rows rows (a larger
+    station gets a range of its own), reading only the station column.
+
+    Returns:
+    - np.ndarray — first station id of each range, sorted
+    """
+    counts = Counter()
+    for path in files:
+        with fs.open(path, "rb") as f:
+            for batch in pq.ParquetFile(f).iter_batches(columns=[station_col]):
+                vc = pc.value_counts(batch.column(0)).to_pylist()
+                counts.update({item["values"]: item["counts"] for item in vc})
+    starts, rows = [], 0
+    for station in sorted(s for s in counts if s is not None):
+        if not starts or rows + counts[station] > max_rows:
+            starts.append(station)
+            rows = 0
+        rows += counts[station]
+    return np.array(starts or [""], dtype=str)
+
+def compact_month(fs, path, keys=None, row_group_size=None, max_rows=None, max_file_rows=None, dry_run=False):
+    """
+    Compact one monthly archive: stream every record batch of its current files into
+    per-station-range spill files, then de-duplicate (later parts win) and sort one range
+    at a time and append it to the compacted output. Outputs are published as new part
+    files, named to sort between the inputs and any later part (see compacted_part_name),
+    before the inputs are removed; readers drop the overlap in between.
+
+    Returns:
+    - int — rows in the compacted month (0 when there was nothing to compact)
+    """
+    row_group_size = row_group_size or config.ARCHIVE_ROW_GROUP_SIZE
+    max_rows = max_rows or config.COMPACT_MAX_ROWS_IN_MEMORY
+    max_file_rows = max_file_rows or config.COMPACT_MAX_FILE_ROWS
+
+    files = list_archive_files(fs, path)
+    if len(files) < 2:
+        print(f"ℹ️ {path}: {len(files)} file(s), nothing to compact")
+        return 0
+    schemas = []
+    for p in files:
+        with fs.open(p, "rb") as f:
+            schemas.append(pq.read_schema(f))
+    schema = month_schema(schemas)
+    keys, sort_cols = archive_keys(schema.names, keys)
+    if keys is None:
+        raise ValueError(f"No ARCHIVE_KEYS entry matches columns {schema.names}")
+    station_col = keys[0]
+    if dry_run:
+        print(f"🔎 {path}: {len(files)} files, keys {keys}, sort {sort_cols}")
+        return 0
+
+    print(f"🔧 Compacting {len(files)} files of {path}...")
+    buckets = station_buckets(fs, files, station_col, max_rows)
+    dataset_dir = archive_dataset_path(path)
+    fs.makedirs(dataset_dir, exist_ok=True)
+    local = not dataset_dir.startswith("s3://")
+    published, total = [], 0
+
+    with tempfile.TemporaryDirectory(dir=config.TMP) as spill_dir:
+        # pass 1: spill every batch, in file order, to the spill file of its station range
+        writers = {}
+        try:
+            for p in files:
+                with fs.open(p, "rb") as f:
+                    for batch in pq.ParquetFile(f).iter_batches():
+                        batch = align_batch(batch, schema)
+                        stations = batch.column(station_col).to_numpy(zero_copy_only=False).astype(str)
+                        bucket_ids = np.maximum(np.searchsorted(buckets, stations, side="right") - 1, 0)
+                        for b in np.unique(bucket_ids):
+                            if b not in writers:
+                                writers[b] = pq.ParquetWriter(os.path.join(spill_dir, f"{b:06d}.parquet"), schema)
+                            writers[b].write_batch(batch.filter(pa.array(bucket_ids == b)))
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+        def open_output():
+            out_path = f"{dataset_dir}/{compacted_part_name(files[-1], len(published))}"
+            tmp_path = f"{dataset_dir}/.{os.path.basename(out_path)}.tmp" if local else out_path
+            out_file = fs.open(tmp_path, "wb")
+            writer = pq.ParquetWriter(out_file, schema, **archive_write_options(schema.names, keys))
+            return out_path, tmp_path, out_file, writer
+
+        # pass 2: one station range in memory at a time, buffered so the compacted files get
+        # full row groups rather than one short group per range
+        writer = out_file = None
+        file_rows = 0
+        pending, pending_rows = [], 0
+        try:
+            for b in sorted(writers):
+                df = pq.read_table(os.path.join(spill_dir, f"{b:06d}.parquet")).to_pandas()
+                # station ids come back categorical (dictionary-typed); sort them as strings
+                df = sort_archive_frame(df.drop_duplicates(subset=keys, keep="last"), sort_cols)
+                table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+                pending.append(table)
+                pending_rows += table.num_rows
+                total += table.num_rows
+                # whole row groups only; the rest waits for the next station range
+                n_write = pending_rows - pending_rows % row_group_size
+                if not n_write:
+                    continue
+                buffered = pa.concat_tables(pending)
+                if writer is None:
+                    out_path, tmp_path, out_file, writer = open_output()
+                writer.write_table(buffered.slice(0, n_write), row_group_size=row_group_size)
+                pending = [buffered.slice(n_write)]
+                pending_rows -= n_write
+                file_rows += n_write
+                if file_rows >= max_file_rows:
+                    published.append(_publish(fs, writer, out_file, tmp_path, out_path))
+                    writer, file_rows = None, 0
+            if pending_rows:
+                if writer is None:
+                    out_path, tmp_path, out_file, writer = open_output()
+                writer.write_table(pa.concat_tables(pending), row_group_size=row_group_size)
+            if writer is not None:
+                published.append(_publish(fs, writer, out_file, tmp_path, out_path))
+                writer = None
+        except Exception:
+            if writer is not None:
+                writer.close()
+                out_file.close()
+                fs.rm(tmp_path)
+            # inputs stay untouched; drop what was written so far
+            for p in published:
+                fs.rm(p)
+            raise
+
+    for p in files:
+        fs.rm(p)
+    print(f"✅ {path}: {len(files)} files -> {len(published)} file(s), {total} rows")
+    return total
+
+def _publish(fs, writer, out_file, tmp_path, out_path):
+    """Finish one compacted file and move a local temp file into place (S3 uploads appear atomically)."""
+    writer.close()
+    out_file.close()
+    if tmp_path != out_path:
+        fs.mv(tmp_path, out_path)
+    return out_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact monthly archive part files into sorted, de-duplicated files")
+    parser.add_argument("paths", nargs="+", help="Monthly archive paths (…_archive.parquet), or roots with --all")
+    parser.add_argument("--all", action="store_true", help="Compact every monthly archive found under the given roots")
+    parser.add_argument("--keys", help="Comma-separated de-duplication keys, station column first (default: ARCHIVE_KEYS)")
+    parser.add_argument("--row-group-size", type=int, help="Rows per row group (default: ARCHIVE_ROW_GROUP_SIZE)")
+    parser.add_argument("--max-rows", type=int, help="Rows sorted in memory at once (default: COMPACT_MAX_ROWS_IN_MEMORY)")
+    parser.add_argument("--profile", help="AWS profile for s3:// paths")
+    parser.add_argument("--dry-run", action="store_true", help="Only list what would be compacted")
+    args = parser.parse_args()
+
+    keys = args.keys.split(",") if args.keys else None
+    failed = 0
+    for root in args.paths:
+        fs = get_fs(root, args.profile)
+        months = find_monthly_archives(fs, root) if args.all else [root]
+        for path in months:
+            try:
+                compact_month(fs, path, keys=keys, row_group_size=args.row_group_size,
+                              max_rows=args.max_rows, dry_run=args.dry_run)
+            except Exception as e:
+                print(f"❌ Failed to compact {path}: {e}")
+                failed += 1
+    raise SystemExit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 from archiver_base import Archiver
-from utils import create_wind_metadata, create_precip_metadata, parse_metadata, get_model_file_list, extract_model_subset_parallel
+from utils import create_wind_metadata, create_precip_metadata, parse_metadata, get_model_file_list, get_model_file_list_s3, extract_model_subset_parallel, parse_date_and_time_from_url
 from pathlib import Path
 import pandas as pd
 import archiver_config as config
@@ -56,7 +56,11 @@ class ModelArchiver(Archiver):
         return meta_df
 
     def fetch_file_list(self, start, end):
-        return get_model_file_list(
+        if self.config.DISCOVERY_MODE == "list":
+            discover = get_model_file_list_s3
+        else:
+            discover = get_model_file_list
+        file_urls, self.discovery_report = discover(
             start=start,
             end=end,
             fcst_hours=self.config.HERBIE_FORECASTS[self.config.MODEL][self.wxelement],
@@ -64,18 +68,33 @@ class ModelArchiver(Archiver):
             base_url=self.config.MODEL_URLS[self.config.MODEL],
             element = self.config.ELEMENT,
             model=self.config.MODEL,
-            domain=self.config.HERBIE_DOMAIN
+            domain=self.config.HERBIE_DOMAIN,
+            return_report=True
         )
+        # ETag/size per file when discovery listed the bucket (DISCOVERY_MODE = "list")
+        self.source_info.update(self.discovery_report.get("objects", {}))
+        return file_urls
+
+    def filter_new_sources(self, archive_path, sources):
+        new = super().filter_new_sources(archive_path, sources)
+        if self.config.MODEL == "hrrr" and self.wxelement in ["precip6hr", "snow6hr"]:
+            # 6-h amounts come from differencing the cycle's running totals, so a cycle with
+            # any new file is extracted whole
+            new_cycles = {parse_date_and_time_from_url(url, "hrrr") for url in new}
+            new = [url for url in sources if parse_date_and_time_from_url(url, "hrrr") in new_cycles]
+        return new
 
     def process_files(self, file_urls):
-        return extract_model_subset_parallel(
+        df, self.source_rows = extract_model_subset_parallel(
             file_urls=file_urls,
             station_df=self.station_df,
             search_strings=self.config.HERBIE_XARRAY_STRINGS[self.config.ELEMENT][self.config.MODEL],
             element=self.config.ELEMENT,
             model=self.config.MODEL,
-            config=self.config
+            config=self.config,
+            return_counts=True
         )
+        return df
 
 if __name__ == "__main__":
     archiver = ModelArchiver(config)
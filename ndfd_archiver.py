@@ -58,7 +58,10 @@ class NDFDArchiver(Archiver):
         return meta_df
 
     def fetch_file_list(self, start, end):
-        return get_ndfd_file_list(start, end, self.config.NDFD_DICT, self.config.ELEMENT)
+        file_list, file_info = get_ndfd_file_list(start, end, self.config.NDFD_DICT, self.config.ELEMENT,
+                                                  return_info=True)
+        self.source_info.update(file_info)
+        return file_list
 
     def process_files(self, file_list):
         if self.config.ELEMENT == "Wind":
@@ -83,5 +86,7 @@ class NDFDArchiver(Archiver):
             sys.exit()
         speed_files = file_list[speed_key]
         dir_files = file_list.get(dir_key, [])
-        return extract_ndfd_forecasts_parallel(speed_files, dir_files, self.station_df, tmp_dir=self.config.TMP)
+        df, self.source_rows = extract_ndfd_forecasts_parallel(speed_files, dir_files, self.station_df,
+                                                               tmp_dir=self.config.TMP, return_counts=True)
+        return df
 
@@ -63,8 +63,19 @@ def run_monthly_archiving(start, end, model_name, element, use_local):
         print(f"\n📆 Processing {model_name.upper()} {element} from {current:%Y-%m-%d} to {chunk_end:%Y-%m-%d}")
         file_urls = archiver.fetch_file_list(current, chunk_end)
         #print(f'File urls are: {file_urls}')
+        if config.USE_CLOUD_STORAGE:
+            output_path = f"{config.S3_URLS[config.MODEL]}{current.year}_{current.month:02d}_{model}_{element.lower()}_archive.parquet"
+        else:
+            output_path = os.path.join(
+                config.MODEL_DIR,
+                model,
+                element.lower(),
+                f"{current.year}_{current.month:02d}_archive.parquet"
+            )
         if not file_urls:
             print("⚠️ No files found for this chunk.")
+        elif not (file_urls := archiver.filter_new_sources(output_path, file_urls)):
+            print("ℹ️ Every file in this chunk is already archived.")
         else:
             df = archiver.process_files(file_urls)
             #print(f'Dataframe is: {df[df['station_id']=='ERXA2'].head(10)}')
@@ -73,16 +84,11 @@ def run_monthly_archiving(start, end, model_name, element, use_local):
                 print("⚠️ No data extracted for this chunk.")
             else:
                 if config.USE_CLOUD_STORAGE:
-                    s3_path = f"{config.S3_URLS[config.MODEL]}{current.year}_{current.month:02d}_{model}_{element.lower()}_archive.parquet"
-                    archiver.write_to_s3(df, s3_path)
+                    written = archiver.write_to_s3(df, output_path)
                 else:
-                    local_path = os.path.join(
-                        config.MODEL_DIR,
-                        model,
-                        element.lower(),
-                        f"{current.year}_{current.month:02d}_archive.parquet"
-                    )
-                    archiver.write_local_output(df, local_path)
+                    written = archiver.write_local_output(df, output_path)
+                if written:
+                    archiver.mark_processed(output_path)
 
         shutil.rmtree(config.TMP, ignore_errors=True)
         os.makedirs(config.TMP, exist_ok=True)
@@ -104,10 +110,16 @@ if __name__ == "__main__":
         action="store_true",
         help="If set, store output locally instead of S3 (overrides USE_CLOUD_STORAGE)"
     )
+    parser.add_argument(
+        "--reprocess",
+        action="store_true",
+        help="If set, process files already recorded in the source manifest"
+    )
 
     args = parser.parse_args()
     start = pd.to_datetime(args.start)
     end = pd.to_datetime(args.end)
+    config.REPROCESS_SOURCES = args.reprocess
     #print(args.element.title())
 
     run_monthly_archiving(start, end, args.model, args.element, args.local)
\ No newline at end of file
@@ -39,20 +39,27 @@ def run_monthly_archiving(start, end, element, use_local):
         filtered_files = archiver.fetch_file_list(current.strftime("%Y%m%d%H%M"), chunk_end.strftime("%Y%m%d%H%M"))
         #print(filtered_files)
         #sys.exit(1)
+        filename = f"{current.year}_{current.month:02d}_ndfd_{element.lower()}_archive.parquet"
+        if config.USE_CLOUD_STORAGE:
+            output_path = f"{config.S3_URLS['ndfd']}{filename}"
+        else:
+            output_path = os.path.join(config.NDFD_DIR, element.lower(), filename)
         file_key = config.NDFD_FILE_STRINGS[element][0]
+        had_files = bool(filtered_files[file_key])
+        # only issuances not yet in this month's archive (direction files stay listed for pairing)
+        filtered_files[file_key] = archiver.filter_new_sources(output_path, filtered_files[file_key])
         if not filtered_files[file_key]:
-            print(f"⚠️ No data for {current} to {chunk_end}")
+            print(f"⚠️ No {'new ' if had_files else ''}data for {current} to {chunk_end}")
         else:
             df = archiver.process_files(filtered_files)
             #print(f'Dataframe is: {df[df['station_id']=='PAJN'].head(10)}')
-            filename = f"{current.year}_{current.month:02d}_ndfd_{element.lower()}_archive.parquet"
 
             if config.USE_CLOUD_STORAGE:
-                s3_url = f"{config.S3_URLS["ndfd"]}{filename}"
-                archiver.write_to_s3(df, s3_url)
+                written = archiver.write_to_s3(df, output_path)
             else:
-                local_path = os.path.join(config.NDFD_DIR, element.lower(), filename)
-                archiver.write_local_output(df, local_path)
+                written = archiver.write_local_output(df, output_path)
+            if written:
+                archiver.mark_processed(output_path)
 
         shutil.rmtree(config.TMP, ignore_errors=True)
         os.makedirs(config.TMP, exist_ok=True)
@@ -66,9 +73,11 @@ if __name__ == "__main__":
     parser.add_argument("--end", required=True, help="End date (e.g. 2022-02-01)")
     parser.add_argument("--element", required=True, help="Forecast element (e.g. Wind, Gust)")
     parser.add_argument("--local", action="store_true", help="Write output locally instead of to S3")
+    parser.add_argument("--reprocess", action="store_true", help="Process files already recorded in the source manifest")
 
     args = parser.parse_args()
     start = pd.to_datetime(args.start)
     end = pd.to_datetime(args.end)
+    config.REPROCESS_SOURCES = args.reprocess
 
     run_monthly_archiving(start, end, args.element, args.local)
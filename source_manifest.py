@@ -0,0 +1,73 @@
+import sqlite3
+from datetime import datetime, timezone
+import archiver_config as config
+
+class SourceManifest:
+    """
+    SQLite record of the source objects (GRIB files on S3/HTTPS) already written to each
+    archive, with their ETag, size and the number of rows they produced.
+
+    Archives are keyed by their monthly output path, so a source that feeds two months
+    (the NDFD issuances a run reaches back for) is processed once for each of them. A
+    source counts as new again when its listed ETag or size changed.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or config.SOURCE_MANIFEST_PATH
+        # overlapping runs share the file: WAL lets readers through while one run records
+        self.conn = sqlite3.connect(self.path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS sources (
+                   archive TEXT NOT NULL,
+                   source TEXT NOT NULL,
+                   etag TEXT,
+                   size INTEGER,
+                   rows INTEGER NOT NULL,
+                   processed_at TEXT NOT NULL,
+                   PRIMARY KEY (archive, source)
+               )"""
+        )
+        self.conn.commit()
+
+    def processed(self, archive):
+        """
+        Returns:
+        - dict[str, tuple] — source -> (etag, size) for every source recorded for archive
+        """
+        rows = self.conn.execute("SELECT source, etag, size FROM sources WHERE archive = ?", (archive,))
+        return {source: (etag, size) for source, etag, size in rows}
+
+    def unseen(self, archive, sources, info=None):
+        """
+        The sources not yet recorded for archive, or whose ETag/size (from info,
+        {source: {"etag", "size"}}) differ from the recorded ones; order is kept.
+        """
+        info = info or {}
+        done = self.processed(archive)
+        new = []
+        for source in sources:
+            if source not in done:
+                new.append(source)
+                continue
+            etag, size = done[source]
+            listed = info.get(source, {})
+            if (etag and listed.get("etag") and etag != listed["etag"]) or \
+                    (size and listed.get("size") and size != listed["size"]):
+                new.append(source)
+        return new
+
+    def record(self, archive, source_rows, info=None):
+        """Mark sources ({source: rows written}) as processed for archive."""
+        info = info or {}
+        now = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO sources (archive, source, etag, size, rows, processed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(archive, source, info.get(source, {}).get("etag"), info.get(source, {}).get("size"),
+                  int(rows), now) for source, rows in source_rows.items()],
+            )
+
+    def close(self):
+        self.conn.close()
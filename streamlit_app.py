@@ -144,7 +144,8 @@ def get_files(
 ) -> Tuple[List[str], str]:
     """
     Returns a list of parquet file paths under root matching the naming template:
-    YYYY_MM_{model}_{element}_archive.parquet
+    YYYY_MM_{model}_{element}_archive.parquet, plus the part files the archivers append
+    under YYYY_MM_{model}_{element}_archive/part-*.parquet.
     Also returns the fsspec protocol ("file" or "s3").
     """
     if use_s3:
@@ -164,6 +165,8 @@ def get_files(
         path = f"{root.rstrip('/')}/{fname}"
         if fs.exists(path):
             matches.append(path)
+        dataset_dir = path[:-len(".parquet")] if path.endswith(".parquet") else path
+        matches.extend(sorted(fs.glob(f"{dataset_dir}/part-*.parquet")))
     return matches, protocol
 
 def _infer_time_col(cols: List[str]) -> Optional[str]:
@@ -206,6 +209,15 @@ def read_dataset(
         fs = fsspec.filesystem("file")
 
     dset = ds.dataset(files, filesystem=fs, format="parquet")
+    if len(files) > 1:
+        # union of the files' columns, newest file's types first: older legacy files are cast to
+        # the current archive schema and columns they predate read as nulls
+        fields = {}
+        for fragment in dset.get_fragments():
+            for field in fragment.physical_schema:
+                fields.setdefault(field.name, []).append(field)
+        dset = ds.dataset(files, filesystem=fs, format="parquet",
+                          schema=pa.schema([versions[-1] for versions in fields.values()]))
     # If user-specified columns include fields not present, pyarrow will error; so we guard a bit.
     cols = columns or None
     if cols:
@@ -217,7 +229,13 @@ def read_dataset(
     else:
         table = dset.to_table(filter=_build_arrow_filter(filters, dset.schema))
 
-    return table.to_pandas()  # let pandas choose native dtypes
+    # dictionary-encoded labels (station ids, zones) as plain strings, so keys from different
+    # archives still compare and merge
+    table = table.cast(pa.schema([pa.field(f.name, f.type.value_type) if pa.types.is_dictionary(f.type) else f
+                                  for f in table.schema]))
+    df = table.to_pandas()  # let pandas choose native dtypes
+    # part files from re-runs can repeat rows until compaction
+    return df.drop_duplicates(ignore_index=True) if len(files) > 1 else df
 
 def _build_arrow_filter(filters, schema) -> Optional[ds.Expression]:
     if not filters:
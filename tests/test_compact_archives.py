@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import fsspec
+import pytest
+
+import archiver_config as config
+import archiver_base
+import compact_archives
+
+
+class PartWriter(archiver_base.Archiver):
+    def fetch_file_list(self, start, end):
+        return []
+
+    def process_files(self, file_list):
+        return pd.DataFrame()
+
+
+def forecast_rows(rng, n, n_stations=400):
+    init = pd.Timestamp("2025-01-01") + pd.to_timedelta(rng.integers(0, 60, n) * 12, unit="h")
+    df = pd.DataFrame({
+        "station_id": [f"S{s:03d}" for s in rng.integers(0, n_stations, n)],
+        "init_time": init,
+        "forecast_hour": rng.integers(1, 40, n),
+        "wind_speed_kt": rng.uniform(0, 40, n).round(2),
+    })
+    df["valid_time"] = df["init_time"] + pd.to_timedelta(df["forecast_hour"], unit="h")
+    return df.drop_duplicates(["station_id", "init_time", "forecast_hour"])
+
+
+@pytest.fixture
+def month(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "USE_SOURCE_MANIFEST", False)
+    monkeypatch.setattr(config, "TMP", str(tmp_path))
+    rng = np.random.default_rng(0)
+    path = tmp_path / "2025_01_archive.parquet"
+    frames = [forecast_rows(rng, 20000)]
+    # a legacy monthly file as written before part files: rows in completion order, plain strings
+    frames[0].to_parquet(path, index=False)
+    writer = PartWriter(config)
+    for _ in range(3):
+        frames.append(forecast_rows(rng, 8000))
+        writer.write_local_output(frames[-1], path)
+    return str(path), frames
+
+
+def test_compacted_month_is_sorted_by_station_and_deduplicated(month):
+    path, frames = month
+    fs = fsspec.filesystem("file")
+
+    total = compact_archives.compact_month(fs, path, row_group_size=4096)
+
+    files = archiver_base.list_archive_files(fs, path)
+    assert len(files) == 1
+    table = pq.read_table(files[0])
+    stations = table.column("station_id").cast("string").to_pylist()
+    assert stations == sorted(stations)
+
+    expected = (pd.concat(frames, ignore_index=True)
+                .drop_duplicates(["station_id", "init_time", "forecast_hour"], keep="last"))
+    assert total == table.num_rows == len(expected)
+    got = table.to_pandas().astype({"station_id": str})
+    got = got.set_index(["station_id", "init_time", "forecast_hour"])["wind_speed_kt"].sort_index()
+    expected = expected.astype({"init_time": "datetime64[ms]"})
+    expected["init_time"] = expected["init_time"].dt.tz_localize("UTC")
+    expected = expected.set_index(["station_id", "init_time", "forecast_hour"])["wind_speed_kt"].sort_index()
+    np.testing.assert_allclose(got.to_numpy(), expected.astype("float32").to_numpy())
+    assert got.index.equals(expected.index)
+
+
+def test_compacted_row_groups_prune_single_station_reads(month):
+    path, _ = month
+    fs = fsspec.filesystem("file")
+    compact_archives.compact_month(fs, path, row_group_size=4096)
+
+    metadata = pq.ParquetFile(archiver_base.list_archive_files(fs, path)[0]).metadata
+    ranges = []
+    for i in range(metadata.num_row_groups):
+        stats = metadata.row_group(i).column(0).statistics
+        ranges.append((stats.min, stats.max))
+    assert metadata.num_row_groups > 5
+    # row groups cover consecutive station ranges, so one station falls in one or two of them
+    assert all(prev[1] <= cur[0] for prev, cur in zip(ranges, ranges[1:]))
+    assert sum(lo <= "S200" <= hi for lo, hi in ranges) <= 2
+    assert metadata.row_group(0).sorting_columns[0].column_index == 0
+    stations = pq.read_table(archiver_base.list_archive_files(fs, path)[0], columns=["station_id"]).column(0)
+    stations = pc.cast(stations, "string")
+    assert pc.all(pc.greater_equal(stations[1:], stations[:-1])).as_py()
@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+eccodes = pytest.importorskip("eccodes")
+pygrib = pytest.importorskip("pygrib")
+
+import archiver_config as config
+import utils
+
+NX, NY = 60, 40
+# section 3 of small polar stereographic (NBM/NDFD AK), Lambert (HRRR) and lat/lon grids
+GRIDS = {
+    "polar_stereographic": (20, {
+        "shapeOfTheEarth": 6, "Nx": NX, "Ny": NY,
+        "latitudeOfFirstGridPointInDegrees": 50.5, "longitudeOfFirstGridPointInDegrees": 190.4,
+        "LaDInDegrees": 60, "orientationOfTheGridInDegrees": 210,
+        "DxInMetres": 40000, "DyInMetres": 40000,
+    }),
+    "lambert": (30, {
+        "shapeOfTheEarth": 6, "Nx": NX, "Ny": NY,
+        "latitudeOfFirstGridPointInDegrees": 52.6, "longitudeOfFirstGridPointInDegrees": 195.1,
+        "LaDInDegrees": 60, "LoVInDegrees": 225, "Latin1InDegrees": 60, "Latin2InDegrees": 60,
+        "DxInMetres": 40000, "DyInMetres": 40000,
+    }),
+    "regular_ll": (0, {
+        "Ni": NX, "Nj": NY, "iDirectionIncrementInDegrees": 0.5, "jDirectionIncrementInDegrees": 0.5,
+    }),
+}
+
+
+def write_grid(tmp_path, name, i_negative, j_positive):
+    template, keys = GRIDS[name]
+    gid = eccodes.codes_grib_new_from_samples("GRIB2")
+    eccodes.codes_set(gid, "gridDefinitionTemplateNumber", template)
+    for key, value in keys.items():
+        eccodes.codes_set(gid, key, value)
+    if name == "regular_ll":
+        # first and last points follow the scanning direction
+        lons, lats = [190.0, 190.0 + (NX - 1) * 0.5], [50.0, 50.0 + (NY - 1) * 0.5]
+        lons = lons[::-1] if i_negative else lons
+        lats = lats if j_positive else lats[::-1]
+        for edge, lat, lon in (("First", lats[0], lons[0]), ("Last", lats[1], lons[1])):
+            eccodes.codes_set(gid, f"latitudeOf{edge}GridPointInDegrees", lat)
+            eccodes.codes_set(gid, f"longitudeOf{edge}GridPointInDegrees", lon)
+    eccodes.codes_set(gid, "iScansNegatively", int(i_negative))
+    eccodes.codes_set(gid, "jScansPositively", int(j_positive))
+    eccodes.codes_set_values(gid, np.arange(NX * NY, dtype=float))
+    path = tmp_path / f"{name}.grib2"
+    path.write_bytes(eccodes.codes_get_message(gid))
+    eccodes.codes_release(gid)
+    return str(path)
+
+
+def decoded_grid(path, decoder):
+    if decoder == "pygrib":
+        with pygrib.open(path) as grbs:
+            grb = grbs.message(1)
+            lats, lons = grb.latlons()
+            return lats, lons, utils.grid_keys_from_message(grb)
+    grib = utils.read_grib_fields(path)
+    return grib["lats"], grib["lons"], grib["grid_keys"]
+
+
+@pytest.mark.parametrize("decoder", ["eccodes", "pygrib"])
+@pytest.mark.parametrize("j_positive", [False, True])
+@pytest.mark.parametrize("i_negative", [False, True])
+@pytest.mark.parametrize("name", list(GRIDS))
+def test_projection_lookup_matches_brute_force_nearest(tmp_path, monkeypatch, name, i_negative, j_positive, decoder):
+    monkeypatch.setattr(config, "USE_GRID_INDEX_STORE", False)
+    lats, lons, grid_keys = decoded_grid(write_grid(tmp_path, name, i_negative, j_positive), decoder)
+    rng = np.random.default_rng(0)
+    jj, ii = rng.integers(0, NY, 100), rng.integers(0, NX, 100)
+    stations = pd.DataFrame({
+        "stid": [f"S{k}" for k in range(100)],
+        "latitude": lats[jj, ii] + rng.normal(0, 0.05, 100),
+        "longitude": lons[jj, ii] + rng.normal(0, 0.1, 100),
+    })
+
+    index = utils.station_grid_index(stations, lats, lons, grid_keys=grid_keys, method="projection")
+
+    # great-circle distance to the chosen point equals the distance to the nearest decoded point
+    st_lats = stations["latitude"].to_numpy()[:, None, None]
+    st_lons = stations["longitude"].to_numpy()[:, None, None]
+    nearest_km = utils.haversine_km(st_lats, st_lons, lats[None], lons[None]).min(axis=(1, 2))
+    chosen_km = utils.haversine_km(stations["latitude"], stations["longitude"],
+                                   lats[index["iy"], index["ix"]], lons[index["iy"], index["ix"]])
+    np.testing.assert_allclose(chosen_km, nearest_km, atol=1e-6)
+
+
+@pytest.mark.parametrize("name", list(GRIDS))
+def test_projection_lookup_only_for_validated_scan_modes(tmp_path, name):
+    analytic = {}
+    for i_negative in (False, True):
+        for j_positive in (False, True):
+            _, _, grid_keys = decoded_grid(write_grid(tmp_path, name, i_negative, j_positive), "eccodes")
+            analytic[i_negative, j_positive] = utils.grid_projection(grid_keys) is not None
+
+    assert analytic == {
+        (False, False): name == "regular_ll",
+        (False, True): True,
+        (True, False): False,
+        (True, True): False,
+    }
@@ -0,0 +1,106 @@
+import pandas as pd
+import pytest
+import requests
+
+boto3 = pytest.importorskip("boto3")
+moto_server = pytest.importorskip("moto.server")
+
+import archiver_config as config
+import utils
+
+# A local moto S3 server stands in for the NOAA buckets. Requests go over real HTTP, so the
+# ListObjectsV2 listing and the HEAD probes both reach it through a path-style endpoint.
+BUCKET = "noaa-nbm-grib2-pds"
+START, END = pd.Timestamp("2025-01-01 00:00"), pd.Timestamp("2025-01-01 06:00")
+CYCLE = "6h"
+FCST_HOURS = [1, 2, 3, 4, 5]
+# f004 is missing from the 00z cycle, and only its .idx from the 06z cycle
+MISSING = {("00", 4, ""), ("00", 4, ".idx"), ("06", 4, ".idx")}
+
+
+def nbm_key(hour, fh, suffix=""):
+    return f"blend.20250101/{hour}/core/blend.t{hour}z.core.f{fh:03d}.ak.grib2{suffix}"
+
+
+@pytest.fixture(scope="module")
+def endpoint():
+    server = moto_server.ThreadedMotoServer(ip_address="127.0.0.1", port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    yield f"http://{host}:{port}"
+    server.stop()
+
+
+@pytest.fixture
+def bucket(endpoint, monkeypatch):
+    monkeypatch.setattr(config, "USE_IDX_CACHE", False)
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    requests.post(f"{endpoint}/moto-api/reset")
+    s3 = boto3.client("s3", endpoint_url=endpoint, region_name="us-east-1")
+    # the NOAA buckets are public: anonymous listing and HEAD must work
+    s3.create_bucket(Bucket=BUCKET, ACL="public-read")
+    for hour in ("00", "06"):
+        for fh in FCST_HOURS:
+            for suffix in ("", ".idx"):
+                if (hour, fh, suffix) not in MISSING:
+                    s3.put_object(Bucket=BUCKET, Key=nbm_key(hour, fh, suffix), Body=b"GRIB" * fh,
+                                  ACL="public-read")
+    return s3, f"{endpoint}/{BUCKET}"
+
+
+def test_list_s3_prefix_follows_continuation_tokens(bucket, monkeypatch):
+    s3, base_url = bucket
+    monkeypatch.setattr(config, "S3_LIST_MAX_KEYS", 3)
+    session = utils.get_http_session()
+    pages = []
+    get = session.get
+
+    def counting_get(url, **kwargs):
+        pages.append(dict(kwargs["params"]))
+        return get(url, **kwargs)
+
+    monkeypatch.setattr(session, "get", counting_get)
+    objects = utils.list_s3_prefix(base_url, "blend.20250101/00/core/")
+
+    assert len(pages) == 3
+    assert "continuation-token" in pages[-1]
+    expected = {nbm_key("00", fh, suffix) for fh in FCST_HOURS for suffix in ("", ".idx")
+                if ("00", fh, suffix) not in MISSING}
+    assert set(objects) == expected
+    head = s3.head_object(Bucket=BUCKET, Key=nbm_key("00", 1))
+    assert objects[nbm_key("00", 1)] == {"etag": head["ETag"].strip('"'), "size": head["ContentLength"]}
+
+
+def test_list_mode_reports_missing_files(bucket):
+    _, base_url = bucket
+    file_urls, report = utils.get_model_file_list_s3(START, END, FCST_HOURS, CYCLE, base_url, "Wind",
+                                                     model="nbm", return_report=True)
+
+    missing = {url for url, _ in report["missing"]}
+    assert missing == {f"{base_url}/{nbm_key('00', 4, '.idx')}", f"{base_url}/{nbm_key('06', 4, '.idx')}"}
+    assert report["failed"] == []
+    assert len(file_urls) == 2 * len(FCST_HOURS) - 2
+    assert set(report["objects"]) == set(file_urls)
+
+
+def test_list_mode_reports_listing_failures(bucket, endpoint):
+    base_url = f"{endpoint}/noaa-missing-bucket-pds"
+    file_urls, report = utils.get_model_file_list_s3(START, END, FCST_HOURS, CYCLE, base_url, "Wind",
+                                                     model="nbm", return_report=True)
+
+    assert file_urls == []
+    assert report["missing"] == []
+    assert len(report["failed"]) == 2 * len(FCST_HOURS)
+
+
+def test_list_and_head_modes_find_the_same_files(bucket):
+    _, base_url = bucket
+    listed, list_report = utils.get_model_file_list_s3(START, END, FCST_HOURS, CYCLE, base_url, "Wind",
+                                                       model="nbm", return_report=True)
+    probed, head_report = utils.get_model_file_list(START, END, FCST_HOURS, CYCLE, base_url, "Wind",
+                                                    model="nbm", return_report=True)
+
+    assert listed == probed
+    assert [url for url, _ in list_report["missing"]] == [url for url, _ in head_report["missing"]]
+    assert head_report["failed"] == []
@@ -1,22 +1,45 @@
 import os
+import io
+import random
+import asyncio
 import gc
-import sys
 import re
 import tempfile
 import shutil
+import hashlib
+import queue
+import threading
+import multiprocessing
 import pygrib
+import eccodes
 import numpy as np
 import pandas as pd
 import requests
+import aiohttp
 import fsspec
+import xml.etree.ElementTree as ET
 import xarray as xr
 from datetime import datetime
 from pathlib import Path
+from functools import lru_cache
+from multiprocessing import shared_memory
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from scipy import sparse
 from scipy.spatial import cKDTree
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from pyproj import CRS, Transformer
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import archiver_config as config  # Update 'your_module' with actual config import path
 
-station_index_cache = {}
+_http_session = None
+_http_session_lock = threading.Lock()
+_host_semaphores = {}
+
+S3_XML_NS = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+# transient HTTP statuses worth retrying (sync session and async engine)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
 
 def K_to_F(kelvin):
   fahrenheit = 1.8*(kelvin-273)+32.
@@ -34,23 +57,30 @@ def MM_to_IN(mm):
 def M_to_IN(m):
     return m*39.3701
 
+def latlon_to_xyz(lats, lons):
+    """Unit-sphere Cartesian coordinates, so chord distance orders points like great-circle distance."""
+    lat = np.radians(np.asarray(lats, dtype=float))
+    lon = np.radians(np.asarray(lons, dtype=float))
+    return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+
 def build_kdtree(lats, lons):
     """
-    Build a cKDTree from 2D lat/lon arrays.
+    Build a cKDTree over 2D lat/lon arrays in 3D Cartesian space (no dateline/pole seams).
     Returns:
         tree: cKDTree object
         shape: original shape of the lat/lon grids
     """
-    latlon_points = np.column_stack((lats.ravel(), lons.ravel()))
-    tree = cKDTree(latlon_points)
-    return tree, lats.shape
+    tree = cKDTree(latlon_to_xyz(np.ravel(lats), np.ravel(lons)))
+    return tree, np.shape(lats)
 
 def query_kdtree(tree, shape, station_lat, station_lon):
     """
-    Query cKDTree and return 2D grid indices (iy, ix)
+    Query cKDTree and return 2D grid indices (iy, ix); accepts scalars or arrays of stations
     """
-    dist, idx = tree.query([station_lat, station_lon])
+    dist, idx = tree.query(latlon_to_xyz(np.ravel(station_lat), np.ravel(station_lon)))
     iy, ix = np.unravel_index(idx, shape)
+    if np.ndim(station_lat) == 0:
+        return iy[0], ix[0]
     return iy, ix
 
 
@@ -92,6 +122,544 @@ def ll_to_index(loclat, loclon, datalats, datalons):
     idx_flat = np.argmin(c)
     return np.unravel_index(idx_flat, lon_arr.shape)
 
+GRID_INDEX_FIELDS = ("iy", "ix", "dist_km", "out_of_domain")
+# GRIB section 3 keys needed to place stations on a grid without decoding its lat/lon arrays
+GRID_DEFINITION_KEYS = (
+    "gridType", "Nx", "Ny", "Ni", "Nj",
+    "latitudeOfFirstGridPointInDegrees", "longitudeOfFirstGridPointInDegrees",
+    "LaDInDegrees", "LoVInDegrees", "orientationOfTheGridInDegrees",
+    "Latin1InDegrees", "Latin2InDegrees", "DxInMetres", "DyInMetres",
+    "iDirectionIncrementInDegrees", "jDirectionIncrementInDegrees",
+    "iScansNegatively", "jScansPositively", "jPointsAreConsecutive", "projectionCentreFlag",
+    "shapeOfTheEarth", "scaledValueOfRadiusOfSphericalEarth", "scaleFactorOfRadiusOfSphericalEarth",
+    "md5Section3",
+)
+# spherical earth radii (m) by GRIB shapeOfTheEarth code; 1 carries its own radius
+EARTH_RADII = {0: 6367470.0, 6: 6371229.0, 8: 6371200.0}
+_grid_index_memo = {}
+_grid_index_lock = threading.Lock()
+# "layout:grid id" -> (lats, lons), plus the shared memory blocks published or attached for them
+_grid_geometry = {}
+_grid_geometry_blocks = {}
+_grid_geometry_lock = threading.Lock()
+_point_operator_memo = {}
+_point_operator_lock = threading.Lock()
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype=float)) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371.0 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def grid_keys_from_dataset(ds):
+    """GRID_DEFINITION_KEYS read by cfgrib (backend_kwargs read_keys)."""
+    for var in ds.data_vars.values():
+        if "GRIB_gridType" in var.attrs:
+            return {k: var.attrs[f"GRIB_{k}"] for k in GRID_DEFINITION_KEYS if f"GRIB_{k}" in var.attrs}
+    return {}
+
+def grid_keys_from_message(grb):
+    """GRID_DEFINITION_KEYS of a pygrib message."""
+    return {k: grb[k] for k in GRID_DEFINITION_KEYS if grb.has_key(k)}
+
+def _earth_radius(grid_keys):
+    shape = grid_keys.get("shapeOfTheEarth")
+    if shape == 1:
+        scale = grid_keys.get("scaleFactorOfRadiusOfSphericalEarth")
+        value = grid_keys.get("scaledValueOfRadiusOfSphericalEarth")
+        if value is None or scale is None:
+            return None
+        return float(value) / 10 ** int(scale)
+    return EARTH_RADII.get(shape)
+
+def grid_projection(grid_keys):
+    """
+    Map a GRIB grid definition to a station → fractional (i, j) transform.
+
+    Supports polar stereographic (NBM/NDFD AK), Lambert conformal (HRRR) and regular
+    lat/lon grids on a spherical earth, scanned row by row in the directions where every
+    decoder (eccodes, pygrib) lays the arrays out in scan order: +i, and for projected
+    grids also +j. Other scan modes fall back to searching the decoded lat/lon arrays.
+
+    Returns:
+    - dict — transformer (lon/lat → projected x/y, None for lat/lon grids), first grid
+      point x0/y0, signed steps dx/dy and the Nx/Ny shape; None when unsupported
+    """
+    return _grid_projection(tuple(sorted(grid_keys.items())))
+
+@lru_cache(maxsize=32)
+def _grid_projection(grid_items):
+    grid_keys = dict(grid_items)
+    grid_type = grid_keys.get("gridType")
+    nx, ny = grid_keys.get("Nx", grid_keys.get("Ni")), grid_keys.get("Ny", grid_keys.get("Nj"))
+    if nx is None or ny is None or grid_keys.get("jPointsAreConsecutive", 0):
+        return None
+    # checked against brute-force nearest on eccodes and pygrib arrays; eccodes does not
+    # follow -j for projected grids and pygrib does not follow -i for lat/lon grids
+    if grid_keys.get("iScansNegatively", 0):
+        return None
+    if grid_type != "regular_ll" and not grid_keys.get("jScansPositively", 0):
+        return None
+    j_sign = 1.0 if grid_keys.get("jScansPositively", 0) else -1.0
+    lat1 = grid_keys.get("latitudeOfFirstGridPointInDegrees")
+    lon1 = grid_keys.get("longitudeOfFirstGridPointInDegrees")
+    if lat1 is None or lon1 is None:
+        return None
+    if grid_type == "regular_ll":
+        if "iDirectionIncrementInDegrees" not in grid_keys or "jDirectionIncrementInDegrees" not in grid_keys:
+            return None
+        return {"transformer": None, "x0": float(lon1), "y0": float(lat1), "nx": int(nx), "ny": int(ny),
+                "dx": float(grid_keys["iDirectionIncrementInDegrees"]),
+                "dy": j_sign * float(grid_keys["jDirectionIncrementInDegrees"])}
+
+    radius = _earth_radius(grid_keys)
+    if radius is None or "DxInMetres" not in grid_keys or "DyInMetres" not in grid_keys:
+        return None
+    if grid_type == "polar_stereographic":
+        lat_0 = -90 if int(grid_keys.get("projectionCentreFlag", 0)) & 128 else 90
+        proj4 = (f"+proj=stere +lat_0={lat_0} +lat_ts={grid_keys['LaDInDegrees']} "
+                 f"+lon_0={grid_keys['orientationOfTheGridInDegrees']}")
+    elif grid_type == "lambert":
+        proj4 = (f"+proj=lcc +lat_1={grid_keys['Latin1InDegrees']} +lat_2={grid_keys['Latin2InDegrees']} "
+                 f"+lat_0={grid_keys['LaDInDegrees']} +lon_0={grid_keys['LoVInDegrees']}")
+    else:
+        return None
+    transformer = Transformer.from_crs(
+        CRS.from_proj4(f"+proj=longlat +R={radius} +no_defs"),
+        CRS.from_proj4(f"{proj4} +x_0=0 +y_0=0 +R={radius} +units=m +no_defs"),
+        always_xy=True,
+    )
+    x0, y0 = transformer.transform(lon1, lat1)
+    return {"transformer": transformer, "x0": x0, "y0": y0, "nx": int(nx), "ny": int(ny),
+            "dx": float(grid_keys["DxInMetres"]), "dy": float(grid_keys["DyInMetres"])}
+
+def projection_fractional_position(projection, st_lats, st_lons):
+    """
+    Fractional grid position of every station from the grid's projection.
+
+    Returns:
+    - tuple — (i, j) float arrays (column, row), NaN for stations without a usable lat/lon
+    """
+    st_lats = np.asarray(st_lats, dtype=float)
+    st_lons = np.asarray(st_lons, dtype=float)
+    transformer = projection["transformer"]
+    if transformer is None:
+        # longitudes wrapped into the 360 degrees centred on the grid, so stations just off
+        # either edge stay next to that edge
+        start = projection["x0"] - (360.0 - (projection["nx"] - 1) * projection["dx"]) / 2
+        x = start + (st_lons - start) % 360.0
+        y = st_lats
+    else:
+        x, y = transformer.transform(st_lons, st_lats)
+    i = (np.asarray(x, dtype=float) - projection["x0"]) / projection["dx"]
+    j = (np.asarray(y, dtype=float) - projection["y0"]) / projection["dy"]
+    return i, j
+
+def locate_on_projection(projection, st_lats, st_lons):
+    """
+    Nearest grid point of every station from the grid's projection, O(stations).
+
+    Stations outside the grid are clamped to the nearest edge point and flagged.
+
+    Returns:
+    - dict — iy, ix (intp arrays), dist_km (float array), out_of_domain (bool array)
+    """
+    st_lats = np.asarray(st_lats, dtype=float)
+    st_lons = np.asarray(st_lons, dtype=float)
+    transformer = projection["transformer"]
+    i, j = projection_fractional_position(projection, st_lats, st_lons)
+    finite = np.isfinite(i) & np.isfinite(j)
+    i = np.where(finite, i, 0.0)
+    j = np.where(finite, j, 0.0)
+    inside = finite & (i > -0.5) & (i < projection["nx"] - 0.5) & (j > -0.5) & (j < projection["ny"] - 0.5)
+    ix = np.clip(np.rint(i), 0, projection["nx"] - 1).astype(np.intp)
+    iy = np.clip(np.rint(j), 0, projection["ny"] - 1).astype(np.intp)
+    gx = projection["x0"] + ix * projection["dx"]
+    gy = projection["y0"] + iy * projection["dy"]
+    if transformer is None:
+        grid_lons, grid_lats = gx, gy
+    else:
+        grid_lons, grid_lats = transformer.transform(gx, gy, direction="INVERSE")
+    dist_km = haversine_km(st_lats, st_lons, grid_lats, grid_lons)
+    return {"iy": iy, "ix": ix, "dist_km": dist_km, "out_of_domain": ~inside}
+
+def grid_id_from_dataset(ds):
+    """md5 of the GRIB grid definition (section 3) carried on a cfgrib/eccodes dataset, or None."""
+    for var in ds.data_vars.values():
+        if var.attrs.get("GRIB_md5Section3"):
+            return var.attrs["GRIB_md5Section3"]
+    return None
+
+def grid_signature_from_latlons(lats, lons):
+    """Fallback grid key when the GRIB grid definition is not available: hash of the coordinates."""
+    digest = hashlib.sha256()
+    for arr in (lats, lons):
+        arr = np.ascontiguousarray(arr, dtype=np.float64)
+        digest.update(str(arr.shape).encode("utf-8"))
+        digest.update(arr.tobytes())
+    return digest.hexdigest()
+
+def grid_corner_fingerprint(lats, lons):
+    """
+    Corner coordinates of a decoded grid, rounded, with lons in -180..180.
+
+    Added to the grid key so decoders that lay out the same grid definition
+    differently (e.g. scanning direction) never share an index.
+    """
+    lats = np.asarray(lats)
+    lons = np.asarray(lons)
+    corners = (0, -1)
+    values = [lats[j, i] for j in corners for i in corners]
+    values += [((lons[j, i] + 180.0) % 360.0) - 180.0 for j in corners for i in corners]
+    return ",".join(f"{v:.4f}" for v in values)
+
+def station_signature(station_df):
+    digest = hashlib.sha256()
+    digest.update(station_df["stid"].astype(str).str.cat(sep="\n").encode("utf-8"))
+    for col in ("latitude", "longitude"):
+        digest.update(np.ascontiguousarray(station_df[col].to_numpy(dtype=float)).tobytes())
+    return digest.hexdigest()
+
+def build_station_grid_index(station_df, lats, lons, method="chebyshev"):
+    """
+    Nearest grid point of every station from decoded lat/lon arrays, its distance and an
+    out-of-domain flag. method "chebyshev" is the original per-station ll_to_index argmin,
+    "kdtree" one 3D Cartesian KD-tree query for all stations.
+
+    A station is flagged when it is farther from its grid point than
+    GRID_INDEX_OUT_OF_DOMAIN_FACTOR local grid spacings (i.e. it snapped to the edge
+    of a grid that does not cover it) or has no usable lat/lon.
+
+    Returns:
+    - dict — iy, ix (intp arrays), dist_km (float array), out_of_domain (bool array)
+    """
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    st_lats = station_df["latitude"].to_numpy(dtype=float)
+    st_lons = station_df["longitude"].to_numpy(dtype=float)
+    if method == "kdtree":
+        finite = np.isfinite(st_lats) & np.isfinite(st_lons)
+        tree, shape = build_kdtree(lats, lons)
+        iy, ix = query_kdtree(tree, shape, np.where(finite, st_lats, 0.0), np.where(finite, st_lons, 0.0))
+        iy = np.asarray(iy, dtype=np.intp)
+        ix = np.asarray(ix, dtype=np.intp)
+    else:
+        pairs = [ll_to_index(lat, lon, lats, lons) for lat, lon in zip(st_lats, st_lons)]
+        iy = np.array([p[0] for p in pairs], dtype=np.intp)
+        ix = np.array([p[1] for p in pairs], dtype=np.intp)
+    dist_km = haversine_km(st_lats, st_lons, lats[iy, ix], lons[iy, ix])
+    dist_km[~(np.isfinite(st_lats) & np.isfinite(st_lons))] = np.nan
+    # spacing to the neighbouring column, so the threshold follows the grid's own resolution
+    ix_next = np.where(ix + 1 < lats.shape[1], ix + 1, ix - 1)
+    spacing_km = haversine_km(lats[iy, ix], lons[iy, ix], lats[iy, ix_next], lons[iy, ix_next])
+    out_of_domain = ~np.isfinite(dist_km) | (dist_km > config.GRID_INDEX_OUT_OF_DOMAIN_FACTOR * spacing_km)
+    return {"iy": iy, "ix": ix, "dist_km": dist_km, "out_of_domain": out_of_domain}
+
+def station_grid_index(station_df, lats=None, lons=None, grid_id=None, grid_keys=None, method=None):
+    """
+    Station → grid point index for one grid, reused across files, runs and processes.
+
+    GRID_LOOKUP "projection" places stations analytically from the GRIB grid definition
+    (grid_keys) and needs no lat/lon arrays; grids it cannot handle fall back to "kdtree".
+    "kdtree" and "chebyshev" (the original ll_to_index argmin) search the lats/lons.
+
+    Keyed by method, grid definition (grid_id, normally GRIB md5Section3; a hash of
+    lats/lons otherwise) and station list, kept in memory and as .npz under GRID_INDEX_DIR.
+
+    Returns:
+    - dict — iy, ix (intp arrays), dist_km (float array), out_of_domain (bool array)
+    """
+    method = method or config.GRID_LOOKUP
+    grid_keys = grid_keys or {}
+    projection = grid_projection(grid_keys) if method == "projection" else None
+    if projection is None:
+        if lats is None or lons is None:
+            raise ValueError(f"Grid {grid_keys.get('gridType')} needs decoded lat/lon arrays for station lookup")
+        if method == "projection":
+            method = "kdtree"
+    grid_id = grid_id or grid_keys.get("md5Section3")
+    if projection is not None:
+        grid_id = grid_id or hashlib.sha256(repr(sorted(grid_keys.items())).encode("utf-8")).hexdigest()
+        layout = "analytic"
+    else:
+        grid_id = grid_id or grid_signature_from_latlons(lats, lons)
+        layout = grid_corner_fingerprint(lats, lons)
+    key_text = f"{method}:{grid_id}:{layout}:{station_signature(station_df)}"
+    key = hashlib.sha256(key_text.encode("utf-8")).hexdigest()
+    with _grid_index_lock:
+        if key in _grid_index_memo:
+            return _grid_index_memo[key]
+
+    path = Path(config.GRID_INDEX_DIR) / f"{key}.npz"
+    index = None
+    if config.USE_GRID_INDEX_STORE and path.exists():
+        try:
+            with np.load(path) as stored:
+                index = {field: stored[field] for field in GRID_INDEX_FIELDS}
+        except (OSError, KeyError, ValueError) as e:
+            print(f"⚠️ Ignoring unreadable grid index {path.name}: {e}")
+    if index is None:
+        print(f"🔎 Building station grid index for {len(station_df)} stations (grid {grid_id[:12]}, {method})")
+        if projection is not None:
+            index = locate_on_projection(projection, station_df["latitude"], station_df["longitude"])
+        else:
+            index = build_station_grid_index(station_df, lats, lons, method=method)
+        n_out = int(index["out_of_domain"].sum())
+        if n_out:
+            print(f"⚠️ {n_out} stations lie outside grid {grid_id[:12]}; their values will be NaN")
+        if config.USE_GRID_INDEX_STORE:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # write-then-rename so other processes never load a partial file
+            tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(tmp_path, "wb") as f_out:
+                np.savez(f_out, **index)
+            os.replace(tmp_path, path)
+    with _grid_index_lock:
+        _grid_index_memo[key] = index
+    return index
+
+def grid_geometry(grid_id, compute, layout="eccodes"):
+    """
+    Lat/lon arrays of a grid, computed at most once per process and shared by every file on it.
+
+    layout names the decoder/convention that produced them ("eccodes" for cfgrib and
+    read_grib_fields, "pygrib", "west" for NDFD lons shifted by -360), since decoders
+    do not lay out every grid definition identically. compute() is only called on a miss;
+    without a grid_id nothing is cached.
+
+    Returns:
+    - tuple — (lats, lons) read-only float64 arrays
+    """
+    if grid_id is None:
+        return compute()
+    key = f"{layout}:{grid_id}"
+    with _grid_geometry_lock:
+        if key not in _grid_geometry:
+            lats, lons = (np.array(arr, dtype=np.float64) for arr in compute())
+            lats.setflags(write=False)
+            lons.setflags(write=False)
+            _grid_geometry[key] = (lats, lons)
+        return _grid_geometry[key]
+
+def share_grid_geometry():
+    """
+    Publish every cached grid in shared memory so worker processes can map it instead of
+    decoding it again or receiving it pickled with each task.
+
+    Returns:
+    - dict — picklable {key: (shared memory name, shape)} for attach_grid_geometry
+    """
+    descriptors = {}
+    with _grid_geometry_lock:
+        for key, (lats, lons) in _grid_geometry.items():
+            if key not in _grid_geometry_blocks:
+                block = shared_memory.SharedMemory(create=True, size=lats.nbytes + lons.nbytes)
+                shared = np.ndarray((2,) + lats.shape, dtype=np.float64, buffer=block.buf)
+                shared[0] = lats
+                shared[1] = lons
+                del shared
+                _grid_geometry_blocks[key] = (block, True)
+            descriptors[key] = (_grid_geometry_blocks[key][0].name, lats.shape)
+    return descriptors
+
+def attach_grid_geometry(descriptors):
+    """Worker side of share_grid_geometry: map the published grids into this process's cache."""
+    with _grid_geometry_lock:
+        for key, (name, shape) in descriptors.items():
+            if key in _grid_geometry:
+                continue
+            block = shared_memory.SharedMemory(name=name)
+            shared = np.ndarray((2,) + tuple(shape), dtype=np.float64, buffer=block.buf)
+            shared.setflags(write=False)
+            _grid_geometry_blocks[key] = (block, False)
+            _grid_geometry[key] = (shared[0], shared[1])
+
+def release_grid_geometry():
+    """
+    Unlink the shared memory blocks this process published; the in-process cache stays.
+
+    Workers keep their attached blocks mapped until they exit.
+    """
+    with _grid_geometry_lock:
+        for key, (block, owner) in list(_grid_geometry_blocks.items()):
+            if owner:
+                block.close()
+                block.unlink()
+                del _grid_geometry_blocks[key]
+
+def latlon_fractional_position(lats, lons, iy, ix, st_lats, st_lons):
+    """
+    Fractional grid position of every station from decoded lat/lon arrays, for grids the
+    projection lookup cannot handle: the offset from the nearest point (iy, ix) is solved
+    against the local grid Jacobian in a flat east/north frame.
+
+    Returns:
+    - tuple — (i, j) float arrays (column, row)
+    """
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    ny, nx = lats.shape
+    cos_lat = np.cos(np.radians(lats[iy, ix]))
+
+    def east_north(jj, ii):
+        d_lon = (lons[jj, ii] - lons[iy, ix] + 180.0) % 360.0 - 180.0
+        return d_lon * cos_lat, lats[jj, ii] - lats[iy, ix]
+
+    # one-sided differences at the grid edges
+    ix_lo, ix_hi = np.maximum(ix - 1, 0), np.minimum(ix + 1, nx - 1)
+    iy_lo, iy_hi = np.maximum(iy - 1, 0), np.minimum(iy + 1, ny - 1)
+    ei_hi, ni_hi = east_north(iy, ix_hi)
+    ei_lo, ni_lo = east_north(iy, ix_lo)
+    ej_hi, nj_hi = east_north(iy_hi, ix)
+    ej_lo, nj_lo = east_north(iy_lo, ix)
+    a, c = (ei_hi - ei_lo) / (ix_hi - ix_lo), (ni_hi - ni_lo) / (ix_hi - ix_lo)
+    b, d = (ej_hi - ej_lo) / (iy_hi - iy_lo), (nj_hi - nj_lo) / (iy_hi - iy_lo)
+    st_lats = np.asarray(st_lats, dtype=float)
+    st_e = ((np.asarray(st_lons, dtype=float) - lons[iy, ix] + 180.0) % 360.0 - 180.0) * cos_lat
+    st_n = st_lats - lats[iy, ix]
+    det = a * d - b * c
+    with np.errstate(invalid="ignore", divide="ignore"):
+        di = (d * st_e - b * st_n) / det
+        dj = (a * st_n - c * st_e) / det
+    return ix + di, iy + dj
+
+class PointOperator:
+    """
+    Station extraction operator for one grid and station list.
+
+    bilinear, idw and mean are a CSR weight matrix (stations × grid points) applied with one
+    sparse product per field, for every time step at once; max is a (stations × block)
+    gather. Missing (NaN) neighbours are dropped and the remaining weights renormalised.
+    """
+
+    def __init__(self, shape, weights=None, gather=None):
+        self.shape = tuple(shape)
+        self.weights = weights
+        self.gather = gather
+
+    def apply(self, values):
+        """
+        Returns:
+        - numpy.ndarray — values.shape[:-2] + (stations,)
+        """
+        values = np.ma.filled(np.ma.asarray(values, dtype=float), np.nan)
+        lead = values.shape[:-2]
+        flat = values.reshape(-1, self.shape[0] * self.shape[1])
+        if self.gather is not None:
+            # fmax skips NaN unless every point in the block is missing
+            out = np.fmax.reduce(flat[:, self.gather], axis=-1)
+        else:
+            finite = np.isfinite(flat)
+            if finite.all():
+                out = (self.weights @ flat.T).T
+            else:
+                total = (self.weights @ np.where(finite, flat, 0.0).T).T
+                weight = (self.weights @ finite.T.astype(float)).T
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    out = np.where(weight > 0, total / weight, np.nan)
+        return out.reshape(lead + (out.shape[-1],))
+
+def build_point_operator(operator, shape, iy, ix, fi=None, fj=None, half_width=1):
+    """
+    Sparse extraction operator from each station's nearest point (iy, ix) and, for bilinear
+    and idw, its fractional grid position (fi, fj).
+
+    bilinear and idw (power 2, distances in grid units) use the 2x2 cell around the station;
+    mean and max the (2*half_width+1)^2 block around its nearest point. Stations beyond the
+    grid use the clamped edge cell, like nearest.
+
+    Returns:
+    - PointOperator
+    """
+    ny, nx = shape
+    iy = np.asarray(iy, dtype=np.intp)
+    ix = np.asarray(ix, dtype=np.intp)
+    n = len(iy)
+    if operator in ("mean", "max"):
+        offsets = np.arange(-half_width, half_width + 1)
+        rows = np.clip(iy[:, None, None] + offsets[None, :, None], 0, ny - 1)
+        cols = np.clip(ix[:, None, None] + offsets[None, None, :], 0, nx - 1)
+        block = (rows * nx + cols).reshape(n, -1)
+        if operator == "max":
+            # clipped duplicates at the edges do not change a max
+            return PointOperator(shape, gather=block)
+        # count each clipped duplicate once so edge stations average the points they cover
+        cells = [np.unique(b) for b in block]
+        flat_idx = np.concatenate(cells)
+        station = np.repeat(np.arange(n), [len(c) for c in cells])
+        weights = np.concatenate([np.full(len(c), 1.0 / len(c)) for c in cells])
+    elif operator in ("bilinear", "idw"):
+        fi = np.where(np.isfinite(fi), fi, ix)
+        fj = np.where(np.isfinite(fj), fj, iy)
+        fi = np.clip(fi, 0, nx - 1)
+        fj = np.clip(fj, 0, ny - 1)
+        i0 = np.clip(np.floor(fi).astype(np.intp), 0, max(nx - 2, 0))
+        j0 = np.clip(np.floor(fj).astype(np.intp), 0, max(ny - 2, 0))
+        corners_i = np.minimum(np.stack([i0, i0 + 1, i0, i0 + 1], axis=1), nx - 1)
+        corners_j = np.minimum(np.stack([j0, j0, j0 + 1, j0 + 1], axis=1), ny - 1)
+        di = np.abs(fi[:, None] - corners_i)
+        dj = np.abs(fj[:, None] - corners_j)
+        if operator == "bilinear":
+            corner_weights = np.clip(1.0 - di, 0, 1) * np.clip(1.0 - dj, 0, 1)
+        else:
+            dist2 = di ** 2 + dj ** 2
+            with np.errstate(divide="ignore"):
+                corner_weights = np.where(dist2 > 1e-12, 1.0 / dist2, 0.0)
+            # a station on a grid point takes that point's value
+            on_point = (dist2 <= 1e-12).any(axis=1)
+            corner_weights[on_point] = (dist2[on_point] <= 1e-12).astype(float)
+        corner_weights /= corner_weights.sum(axis=1, keepdims=True)
+        flat_idx = (corners_j * nx + corners_i).ravel()
+        station = np.repeat(np.arange(n), 4)
+        weights = corner_weights.ravel()
+    else:
+        raise ValueError(f"Unknown point operator {operator!r}")
+    matrix = sparse.csr_matrix((weights, (station, flat_idx)), shape=(n, ny * nx))
+    matrix.sum_duplicates()
+    return PointOperator(shape, weights=matrix)
+
+def station_point_operator(station_df, operator, shape, lats=None, lons=None, grid_id=None, grid_keys=None):
+    """
+    PointOperator for one grid and station list, built once per process.
+
+    Sits on top of station_grid_index (same lookup and arguments); bilinear/idw positions
+    come from the grid projection when GRID_LOOKUP places stations analytically, from the
+    lat/lon arrays otherwise.
+
+    Returns:
+    - PointOperator
+    """
+    index = station_grid_index(station_df, lats, lons, grid_id=grid_id, grid_keys=grid_keys)
+    half_width = config.NEIGHBORHOOD_HALF_WIDTH
+    # the grid index dicts live for the whole process, so their id identifies grid + stations
+    key = (operator, tuple(shape), half_width, id(index))
+    with _point_operator_lock:
+        cached = _point_operator_memo.get(key)
+    if cached is not None and cached[0] is index:
+        return cached[1]
+    fi = fj = None
+    if operator in ("bilinear", "idw"):
+        projection = grid_projection(grid_keys or {}) if config.GRID_LOOKUP == "projection" else None
+        if projection is not None:
+            fi, fj = projection_fractional_position(projection, station_df["latitude"], station_df["longitude"])
+        else:
+            fi, fj = latlon_fractional_position(lats, lons, index["iy"], index["ix"],
+                                                station_df["latitude"], station_df["longitude"])
+    point_operator = build_point_operator(operator, shape, index["iy"], index["ix"], fi, fj, half_width)
+    with _point_operator_lock:
+        _point_operator_memo[key] = (index, point_operator)
+    return point_operator
+
+def mask_out_of_domain(values, index):
+    """
+    NaN for the stations a grid index flags as outside the grid (last axis of values),
+    instead of the value of the edge cell they were clamped to.
+    """
+    out_of_domain = index["out_of_domain"]
+    if not out_of_domain.any():
+        return values
+    values = np.ma.filled(np.ma.asarray(values, dtype=float), np.nan)
+    return np.where(out_of_domain, np.nan, values)
+
 def create_wind_metadata(url, token, state, vars, precip=0):
     if precip==0:
         params = {
@@ -141,7 +709,15 @@ def extract_timestamp(filename):
     time_str = os.path.basename(filename).split("_")[-1]
     return datetime.strptime(time_str, "%Y%m%d%H%M")
 
-def get_ndfd_file_list(start, end, element_dict, element_type):
+def get_ndfd_file_list(start, end, element_dict, element_type, return_info=False):
+    """
+    NDFD WMO files of each component of element_type issued at 11Z/23Z from three days
+    before start through end.
+
+    Returns:
+    - dict[str, list[str]] — component -> S3 keys
+    - (dict, dict) if return_info — plus key -> {"etag": str, "size": int} from the listing
+    """
     start = pd.to_datetime(start, format="%Y%m%d%H%M") - pd.Timedelta(days=3)
     end = pd.to_datetime(end, format="%Y%m%d%H%M")
     date_range = pd.date_range(start=start, end=end, freq="D")
@@ -167,121 +743,180 @@ def get_ndfd_file_list(start, end, element_dict, element_type):
         filtered_files = {"snow": []}
         components = ["snow"]
 
+    file_info = {}
     for component in components:
         prefixes = element_dict[element_type][component]
         for tdate in date_range:
             for prefix in prefixes:
                 pattern = f"{base_s3}/{component}/{tdate:%Y}/{tdate:%m}/{tdate:%d}/{prefix}_*"
                 try:
-                    matched_files = fs.glob(pattern)
-                    for file in matched_files:
+                    matched_files = fs.glob(pattern, detail=True)
+                    for file, details in matched_files.items():
                         filename = os.path.basename(file)
                         try:
                             ftime = datetime.strptime(filename.split("_")[-1], "%Y%m%d%H%M")
                             if ftime.hour in [11, 23]:
                                 filtered_files[component].append(file)
+                                file_info[file] = {"etag": (details.get("ETag") or "").strip('"') or None,
+                                                   "size": details.get("size")}
                         except ValueError:
                             continue
                 except Exception as e:
                     print(f"⚠️ Could not fetch files for {pattern}: {e}")
 
+    if return_info:
+        return filtered_files, file_info
     return filtered_files
 
+# NDFD element -> (output column, unit conversion, decimals); other elements keep raw values
+NDFD_ELEMENT_COLUMNS = {
+    "Wind": ("wind_speed_kt", MS_to_KTS, 2),
+    "Gust": ("wind_gust_kt", MS_to_KTS, 2),
+    "precip6hr": ("precip6hr", MM_to_IN, 2),
+    "maxt": ("maxt", K_to_F, 2),
+    "mint": ("mint", K_to_F, 2),
+    "snow6hr": ("snow6hr", M_to_IN, 1),
+}
+
 def process_file_pair(speed_file, dir_file, station_df, tmp_dir, element_keys):
-    records = []
+    frame = pd.DataFrame()
     try:
         speed_url = f'simplecache::s3://{speed_file}'
         dir_url = f'simplecache::s3://{dir_file}' if dir_file else None
-
+        operator = config.POINT_OPERATORS.get(config.ELEMENT, "nearest")
+
+        def speed_points(grid):
+            # nearest-point gather or one sparse product per step
+            index = station_grid_index(station_df, grid["lats"], grid["lons"],
+                                       grid_id=grid["grid_id"], grid_keys=grid["grid_keys"])
+            if operator == "nearest":
+                return lambda values: mask_out_of_domain(values[index["iy"], index["ix"]], index)
+            point_operator = station_point_operator(station_df, operator, grid["shape"], grid["lats"], grid["lons"],
+                                                    grid_id=grid["grid_id"], grid_keys=grid["grid_keys"])
+            return lambda values: mask_out_of_domain(point_operator.apply(values), index)
+
+        def dir_points(grid):
+            index = station_grid_index(station_df, grid["lats"], grid["lons"],
+                                       grid_id=grid["grid_id"], grid_keys=grid["grid_keys"])
+            return lambda values: mask_out_of_domain(values[index["iy"], index["ix"]], index)
+
+        # one GRIB message (forecast step) decoded at a time; only station values are kept
+        spd_key = element_keys[0]
         with fsspec.open(speed_url, s3={"anon": True}, filecache={"cache_storage": tmp_dir}) as f_speed:
-            ds_speed = xr.open_dataset(f_speed.name, engine='cfgrib', backend_kwargs={'indexpath': ''}, decode_timedelta=True)
-        #print(f"Our dataset is: {ds_speed}")
-        ds_dir = None
-        if dir_url:
+            speed = read_grib_station_steps(f_speed.name, spd_key, speed_points, layout="west")
+        if speed is None:
+            raise ValueError(f"no {spd_key} messages found")
+        direction = None
+        if dir_url and len(element_keys) > 1:
             with fsspec.open(dir_url, s3={"anon": True}, filecache={"cache_storage": tmp_dir}) as f_dir:
-                ds_dir = xr.open_dataset(f_dir.name, engine='cfgrib', backend_kwargs={'indexpath': ''}, decode_timedelta=True)
-
-        lats = ds_speed.latitude.values
-        lons = ds_speed.longitude.values - 360
-        steps = pd.to_timedelta(ds_speed.step.values)
-        valid_times = pd.to_datetime(ds_speed.valid_time.values)
-
-        spd_key = element_keys[0]
-        speed_array = ds_speed[spd_key].values
-        dir_array = ds_dir[element_keys[1]].values if ds_dir and len(element_keys) > 1 else None
-
-        for _, row in station_df.iterrows():
-            stid = row["stid"]
-            lat = row["latitude"]
-            lon = row["longitude"]
-
-            if stid in station_index_cache:
-                iy, ix = station_index_cache[stid]
-            else:
-                iy, ix = ll_to_index(lat, lon, lats, lons)
-                station_index_cache[stid] = (iy, ix)
-
-            spd_values = speed_array[:, iy, ix]
-            dir_values = dir_array[:, iy, ix] if dir_array is not None else [None] * len(spd_values)
-
-            for step, valid_time, spd, direc in zip(steps, valid_times, spd_values, dir_values):
-                step_hr = int(step.total_seconds() / 3600)
-                record = {
-                    "station_id": stid,
-                    "valid_time": valid_time,
-                    "forecast_hour": step_hr,
-                }
-                if config.ELEMENT == "Wind":
-                    record["wind_speed_kt"] = round(float(MS_to_KTS(spd)), 2)
-                    if direc is not None:
-                        record["wind_dir_deg"] = round(float(direc), 0)
-                elif config.ELEMENT == "Gust":
-                    record["wind_gust_kt"] = round(float(MS_to_KTS(spd)), 2)
-                elif config.ELEMENT == "precip6hr":
-                    record["precip6hr"] = round(float(MM_to_IN(spd)), 2)
-                elif config.ELEMENT == "maxt":
-                    record["maxt"] = round(float(K_to_F(spd)), 2)
-                elif config.ELEMENT == "mint":
-                    record["mint"] = round(float(K_to_F(spd)), 2)
-                elif config.ELEMENT == "snow6hr":
-                    record["snow6hr"] = round(float(M_to_IN(spd)), 1)
-                else:
-                    record[spd_key] = float(spd)
-
-                records.append(record)
+                direction = read_grib_station_steps(f_dir.name, element_keys[1], dir_points, layout="west")
+
+        # (steps x stations) -> station-major rows, as the per-station/per-step records were
+        n_stations = len(station_df)
+        speed_points = speed["points"].reshape(-1, n_stations)
+        n_steps = speed_points.shape[0]
+        column, convert, digits = NDFD_ELEMENT_COLUMNS.get(config.ELEMENT, (spd_key, None, None))
+        speed_values = speed_points.T.ravel()
+        if convert is not None:
+            speed_values = np.round(convert(speed_values).astype(float), digits)
+        columns = {
+            "station_id": np.repeat(station_df["stid"].to_numpy(), n_steps),
+            "valid_time": np.tile(speed["valid_time"], n_stations),
+            "forecast_hour": np.tile(speed["steps"], n_stations),
+            column: speed_values.astype(float),
+        }
+        if config.ELEMENT == "Wind" and direction is not None:
+            # direction steps aligned to the speed steps, NaN where the direction file lacks one
+            dir_points = np.full((n_steps, n_stations), np.nan)
+            rows = {step: k for k, step in enumerate(direction["steps"])}
+            for k, step in enumerate(speed["steps"]):
+                if step in rows:
+                    dir_points[k] = direction["points"][rows[step]]
+            columns["wind_dir_deg"] = np.round(dir_points.T.ravel(), 0)
+        frame = pd.DataFrame(columns)
 
     except Exception as e:
         print(f"❌ Failed to process {speed_file} + {dir_file}: {e}")
-    return pd.DataFrame.from_records(records)
+    return frame
+
+def _ndfd_file_frame(files, prefixes):
+    """Files sorted by issuance time, tagged with the position of their WMO prefix in NDFD_DICT."""
+    names = [os.path.basename(f) for f in files]
+    return pd.DataFrame({
+        "file": list(files),
+        "time": np.array([extract_timestamp(f) for f in files], dtype="datetime64[ns]"),
+        "series": np.array([prefixes.index(n.split("_")[0]) if n.split("_")[0] in prefixes else -1
+                            for n in names], dtype=int),
+    }).sort_values("time", kind="stable")
+
+def pair_ndfd_files(component_files, element_dict=None, tolerance=None):
+    """
+    Pair every file of the first component with the nearest-in-time file of each other
+    component, within tolerance and from the same product series (YCRZ98 with YBRZ98,
+    YCRZ97 with YBRZ97). One sorted merge_asof per extra component.
 
-def extract_ndfd_forecasts_parallel(speed_files, direction_files, station_df, tmp_dir):
+    Returns:
+        - list[tuple] — one file per component in component order (None where unmatched)
+        - dict — component -> files that were not paired
+    """
+    element_dict = element_dict if element_dict is not None else config.NDFD_DICT.get(config.ELEMENT, {})
+    tolerance = pd.Timedelta(tolerance or config.NDFD_PAIR_TOLERANCE)
+    components = list(component_files)
+    primary = components[0]
+
+    paired = _ndfd_file_frame(component_files[primary], element_dict.get(primary, []))
+    paired = paired.rename(columns={"file": primary})
+    for component in components[1:]:
+        other = _ndfd_file_frame(component_files[component], element_dict.get(component, []))
+        paired = pd.merge_asof(paired, other.rename(columns={"file": component}), on="time",
+                               by="series", direction="nearest", tolerance=tolerance)
+
+    paired = paired[components].astype(object).where(paired[components].notna(), None)
+    unmatched = {primary: paired.loc[paired[components].isna().any(axis=1), primary].tolist()}
+    for component in components[1:]:
+        used = set(paired[component].dropna())
+        unmatched[component] = [f for f in component_files[component] if f not in used]
+    return list(paired.itertuples(index=False, name=None)), unmatched
+
+def extract_ndfd_forecasts_parallel(speed_files, direction_files, station_df, tmp_dir, return_counts=False):
+    """
+    Station forecasts from every speed (first component) file, paired with its direction file.
+
+    Returns:
+    - pd.DataFrame
+    - (pd.DataFrame, dict) if return_counts — plus speed file -> rows, for files whose
+      components were all found and that produced rows
+    """
     print(f"TMP dir is: {tmp_dir}")
     element_keys = config.NDFD_ELEMENT_STRINGS[config.ELEMENT]
-    speed_with_time = sorted([(f, extract_timestamp(f)) for f in speed_files], key=lambda x: x[1])
-    dir_with_time = sorted([(f, extract_timestamp(f)) for f in direction_files], key=lambda x: x[1])
-    matched_pairs = []
-
-    for speed_file, speed_time in speed_with_time:
-        if len(element_keys) > 1:
-            closest_match = None
-            min_diff = pd.Timedelta("2 minutes")
-            for dir_file, dir_time in dir_with_time:
-                diff = abs(dir_time - speed_time)
-                if diff <= min_diff:
-                    closest_match = dir_file
-                    min_diff = diff
-            matched_pairs.append((speed_file, closest_match))
-        else:
-            matched_pairs.append((speed_file, None))
+    if len(element_keys) > 1:
+        components = config.NDFD_FILE_STRINGS[config.ELEMENT]
+        matched_pairs, unmatched = pair_ndfd_files({components[0]: speed_files, components[1]: direction_files})
+        for component, files in unmatched.items():
+            if files:
+                print(f"⚠️ {len(files)} {component} file(s) without a match within {config.NDFD_PAIR_TOLERANCE}: "
+                      f"{', '.join(os.path.basename(f) for f in files[:5])}{' ...' if len(files) > 5 else ''}")
+    else:
+        matched_pairs = [(f, None) for f in sorted(speed_files, key=extract_timestamp)]
 
     results = []
-    with ThreadPoolExecutor(max_workers=config.MAX_WORKERS) as executor:
-        futures = [executor.submit(process_file_pair, s, d, station_df, tmp_dir, element_keys) for s, d in matched_pairs]
+    counts = {}
+    with ThreadPoolExecutor(max_workers=config.NDFD_MAX_WORKERS) as executor:
+        futures = {executor.submit(process_file_pair, s, d, station_df, tmp_dir, element_keys): (s, d)
+                   for s, d in matched_pairs}
         for i, future in enumerate(as_completed(futures), 1):
-            results.append(future.result())
+            frame = future.result()
+            results.append(frame)
+            speed_file, dir_file = futures[future]
+            # a speed file still waiting for its direction file is not done yet
+            if len(frame) and (dir_file is not None or len(element_keys) == 1):
+                counts[speed_file] = len(frame)
             print(f"✅ Completed {i}/{len(matched_pairs)} file pairs.")
-    
-    return pd.concat(results, ignore_index=True)
+
+    df = pd.concat(results, ignore_index=True)
+    if return_counts:
+        return df, counts
+    return df
 
 def generate_model_date_range(model, config):
     cycle = config.HERBIE_CYCLES[model]
@@ -374,12 +1009,155 @@ def labels_for_day_accum(fcst_hour: int, interval=24):
     return alts
 
 
-def get_model_file_list(start, end, fcst_hours, cycle, base_url, element, model="nbm", domain="ak"):
+def get_http_session():
+    """
+    Return the process-wide requests.Session used for NOAA bucket traffic.
+
+    The session keeps connections alive between requests and its pool is sized
+    so that every discovery/download worker can hold its own connection.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            retries = Retry(
+                total=config.MAX_RETRIES,
+                connect=config.MAX_RETRIES,
+                read=config.MAX_RETRIES,
+                status=config.MAX_RETRIES,
+                backoff_factor=config.INITIAL_WAIT,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=frozenset(["HEAD", "GET"]),
+            )
+            adapter = HTTPAdapter(
+                pool_connections=config.HTTP_POOL_CONNECTIONS,
+                pool_maxsize=config.HTTP_POOL_MAXSIZE,
+                max_retries=retries,
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+        return _http_session
+
+def _host_semaphore(url, limit):
+    """Per-host semaphore so one bucket never sees more than `limit` requests in flight."""
+    host = urlparse(url).netloc
+    with _http_session_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(limit)
+        return _host_semaphores[host]
+
+def _cycle_time_from_url(url):
+    """Pull the init time out of a NOAA bucket URL (blend.YYYYMMDD/HH/..., hrrr.YYYYMMDD/...tHHz...)."""
+    date_match = re.search(r"\.(\d{8})/", url)
+    hour_match = re.search(r"\.t(\d{2})z\.", url) or re.search(r"\.\d{8}/(\d{2})/", url)
+    if not date_match:
+        return None
+    hour = int(hour_match.group(1)) if hour_match else 0
+    return pd.Timestamp(datetime.strptime(date_match.group(1), "%Y%m%d")) + pd.Timedelta(hours=hour)
+
+def idx_cache_path(idx_url):
+    digest = hashlib.sha256(idx_url.encode("utf-8")).hexdigest()
+    return Path(config.IDX_CACHE_DIR) / digest[:2] / f"{digest}.idx"
+
+def read_cached_idx(idx_url):
+    """
+    Return cached .idx text for idx_url, or None if absent or stale.
+
+    Index files for past cycles are immutable and never expire; cycles newer than
+    IDX_CACHE_RECENT_HOURS are only trusted for IDX_CACHE_TTL_MINUTES.
+    """
+    if not config.USE_IDX_CACHE:
+        return None
+    path = idx_cache_path(idx_url)
+    try:
+        mtime = path.stat().st_mtime
+    except FileNotFoundError:
+        return None
+    cycle_time = _cycle_time_from_url(idx_url)
+    now = pd.Timestamp.now(tz="UTC").tz_localize(None)
+    if cycle_time is None or now - cycle_time < pd.Timedelta(hours=config.IDX_CACHE_RECENT_HOURS):
+        age = now - pd.Timestamp(mtime, unit="s")
+        if age > pd.Timedelta(minutes=config.IDX_CACHE_TTL_MINUTES):
+            return None
+    return path.read_text()
+
+def write_cached_idx(idx_url, text):
+    if not config.USE_IDX_CACHE:
+        return
+    path = idx_cache_path(idx_url)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # write-then-rename so concurrent readers never see a partial file
+    tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp_path.write_text(text)
+    os.replace(tmp_path, path)
+
+def _fetch_idx(idx_url, timeout=None):
     """
-    Generate available NBM HTTPS URLs by checking if the index file (.idx) exists.
+    Read an .idx through the on-disk cache, downloading it on a miss.
 
     Returns:
-    - list[str] — HTTPS URLs to GRIB2 files
+    - (text or None, status_code or None, reason/error text)
+    """
+    text = read_cached_idx(idx_url)
+    if text is not None:
+        return text, 200, "cached"
+    try:
+        with _host_semaphore(idx_url, config.DISCOVERY_PER_HOST):
+            r = get_http_session().get(idx_url, timeout=timeout or config.DISCOVERY_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        return None, None, str(e)
+    if not r.ok:
+        return None, r.status_code, r.reason
+    write_cached_idx(idx_url, r.text)
+    return r.text, r.status_code, r.reason
+
+def fetch_idx_text(idx_url, timeout=None):
+    """Return the text of an .idx file (cached when possible), or None if unavailable."""
+    return _fetch_idx(idx_url, timeout=timeout)[0]
+
+def probe_urls(urls, max_workers=None, per_host=None, timeout=None):
+    """
+    HEAD a list of URLs concurrently over the shared keep-alive session.
+
+    .idx URLs are read through the idx cache instead (a cache hit costs no request and a
+    miss GETs the small index once so download_subset can reuse it).
+
+    Returns:
+    - dict[str, tuple] — url -> (ok, status_code or None, reason/error text)
+    """
+    max_workers = max_workers or config.DISCOVERY_WORKERS
+    per_host = per_host or config.DISCOVERY_PER_HOST
+    timeout = timeout or config.DISCOVERY_TIMEOUT
+    session = get_http_session()
+
+    def _probe(url):
+        if config.USE_IDX_CACHE and url.endswith(".idx"):
+            text, status, reason = _fetch_idx(url, timeout=timeout)
+            return url, (text is not None, status, reason)
+        with _host_semaphore(url, per_host):
+            try:
+                r = session.head(url, timeout=timeout)
+                return url, (r.ok, r.status_code, r.reason)
+            except requests.exceptions.RequestException as e:
+                return url, (False, None, str(e))
+
+    results = {}
+    if not urls:
+        return results
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(urls))) as executor:
+        futures = [executor.submit(_probe, url) for url in urls]
+        for future in as_completed(futures):
+            url, result = future.result()
+            results[url] = result
+    return results
+
+def build_model_candidates(start, end, fcst_hours, cycle, base_url, model="nbm", domain="ak"):
+    """
+    Build the ordered list of expected model files for a date range.
+
+    Returns:
+    - list[tuple[pd.Timestamp, str, str]] — (init time, GRIB2 url, url that proves the file exists)
     """
     if domain == "ak":
         full_domain = "alaska"
@@ -408,8 +1186,7 @@ def get_model_file_list(start, end, fcst_hours, cycle, base_url, element, model=
     else:
         print(f"url formatting for {base_url} for {model} not implemented. Check file name on AWS such as 'blend.t12z.f024.ak.grib2'.")
         raise NotImplementedError
-        sys.exit()
-    file_urls = []
+    candidates = []
     for init in init_times:
         init_date = init.strftime("%Y%m%d")
         init_hour = init.strftime("%H")
@@ -417,324 +1194,826 @@ def get_model_file_list(start, end, fcst_hours, cycle, base_url, element, model=
         if model == 'urma':
             relative_path = f"{designator}.{init_date}/{designator}.t{int(init_hour):02d}z.2dvaranl_ndfd_3p0.grb2"
             full_url = f"{base_url}/{relative_path}"
-            try:
-                r = requests.head(full_url, timeout=5)
-                if r.ok:
-                    file_urls.append(full_url)
-                else:
-                    print(f"⚠️ Missing: {full_url} — {r.status_code}")
-            except requests.exceptions.RequestException as e:
-                print(f"⚠️ Error accessing {idx_url}: {e}")
+            candidates.append((init, full_url, full_url))
         else:
             for fh in fcst_hours:
-                if model == 'nbm':
-                    fxx = f"f{fh:03d}"
-                    relative_path = f"{designator}.{init_date}/{init_hour}/{suite}/{designator}.t{init_hour}z.{suite}.{fxx}.{domain}.grib2"
-                elif model == "nbm_exp":
-                    fxx = f"f{fh:03d}"
-                    relative_path = f"{designator}.{init_date}/{init_hour}/{suite}/{designator}.t{init_hour}z.{suite}.{fxx}.{domain}.grib2"
-                elif model == 'nbmqmd':
-                    fxx = f"f{fh:03d}"
-                    relative_path = f"{designator}.{init_date}/{init_hour}/{suite}/{designator}.t{init_hour}z.{suite}.{fxx}.{domain}.grib2"
-                elif model == 'nbmqmd_exp':
+                if model in ['nbm', 'nbm_exp', 'nbmqmd', 'nbmqmd_exp']:
                     fxx = f"f{fh:03d}"
                     relative_path = f"{designator}.{init_date}/{init_hour}/{suite}/{designator}.t{init_hour}z.{suite}.{fxx}.{domain}.grib2"
                 elif model == 'hrrr':
                     fxx = f"f{fh:02d}"
                     relative_path = f"{designator}.{init_date}/{full_domain}/{designator}.t{init_hour}z.wrf{config.HERBIE_PRODUCTS[config.MODEL]}{fxx}.{domain}.grib2"
                 full_url = f"{base_url}/{relative_path}"
-                idx_url = full_url + ".idx"
+                candidates.append((init, full_url, full_url + ".idx"))
+    return candidates
 
-                try:
-                    r = requests.head(idx_url, timeout=5)
-                    if r.ok:
-                        file_urls.append(full_url)
-                    else:
-                        print(f"⚠️ Missing: {idx_url} — {r.status_code}")
-                except requests.exceptions.RequestException as e:
-                    print(f"⚠️ Error accessing {idx_url}: {e}")
+def get_model_file_list(start, end, fcst_hours, cycle, base_url, element, model="nbm", domain="ak",
+                        return_report=False):
+    """
+    Generate available model HTTPS URLs by checking if the index file (.idx) exists.
+
+    Probes run concurrently (bounded by DISCOVERY_WORKERS / DISCOVERY_PER_HOST) over a
+    shared keep-alive session; the returned list keeps init-time/forecast-hour order.
+
+    Returns:
+    - list[str] — HTTPS URLs to GRIB2 files
+    - (list[str], dict) if return_report — plus {"missing": [(url, status)], "failed": [(url, error)]}
+    """
+    candidates = build_model_candidates(start, end, fcst_hours, cycle, base_url, model=model, domain=domain)
+    print(f"🔎 Probing {len(candidates)} {model} files...")
+    results = probe_urls([probe_url for _, _, probe_url in candidates])
+
+    file_urls = []
+    report = {"missing": [], "failed": []}
+    for _, full_url, probe_url in candidates:
+        ok, status, reason = results[probe_url]
+        if ok:
+            file_urls.append(full_url)
+        elif status is None:
+            print(f"⚠️ Error accessing {probe_url}: {reason}")
+            report["failed"].append((probe_url, reason))
+        else:
+            print(f"⚠️ Missing: {probe_url} — {status}")
+            report["missing"].append((probe_url, status))
+    print(f"🔎 Found {len(file_urls)}/{len(candidates)} files "
+          f"({len(report['missing'])} missing, {len(report['failed'])} failed).")
     #print(f"File urls are: {file_urls}")
+    if return_report:
+        return file_urls, report
     return file_urls
 
 
-def download_subset(remote_url, local_filename, search_strings, model, element,
-                    require_all_matches=True,
-                    required_phrases=None,
-                    exclude_phrases=None):
+def list_s3_prefix(base_url, prefix, timeout=None):
     """
-    Download a subset of a GRIB2 file based on .idx entries matching search_strings.
+    List every object under `prefix` with the S3 ListObjectsV2 API (anonymous, paginated).
 
-    If model == "nbmqpd", apply special logic to match 24-hr APCP percentiles.
+    base_url is the bucket endpoint, e.g. https://noaa-nbm-grib2-pds.s3.amazonaws.com
+    or a path-style endpoint such as http://localhost:9000/noaa-nbm-grib2-pds.
+
+    Returns:
+    - dict[str, dict] — key -> {"etag": str, "size": int}
     """
-    print(f"  > Downloading subset for {os.path.basename(remote_url)}")
-    os.makedirs(os.path.dirname(local_filename), exist_ok=True)
+    timeout = timeout or config.DISCOVERY_TIMEOUT
+    session = get_http_session()
+    list_url = f"{base_url.rstrip('/')}/"
+    params = {"list-type": "2", "prefix": prefix, "max-keys": str(config.S3_LIST_MAX_KEYS)}
+    objects = {}
+    while True:
+        with _host_semaphore(list_url, config.DISCOVERY_PER_HOST):
+            r = session.get(list_url, params=params, timeout=timeout)
+        r.raise_for_status()
+        root = ET.fromstring(r.content)
+        for item in root.findall(f"{S3_XML_NS}Contents"):
+            key = item.findtext(f"{S3_XML_NS}Key")
+            objects[key] = {
+                "etag": (item.findtext(f"{S3_XML_NS}ETag") or "").strip('"'),
+                "size": int(item.findtext(f"{S3_XML_NS}Size") or 0),
+            }
+        if root.findtext(f"{S3_XML_NS}IsTruncated") != "true":
+            break
+        params["continuation-token"] = root.findtext(f"{S3_XML_NS}NextContinuationToken")
+    return objects
+
+def get_model_file_list_s3(start, end, fcst_hours, cycle, base_url, element, model="nbm", domain="ak",
+                           return_report=False):
+    """
+    Same contract as get_model_file_list, but discovers files by listing each cycle
+    once (ListObjectsV2 on the cycle's common key prefix) and intersecting the listing
+    with the expected forecast hours instead of sending one HEAD per file.
+    """
+    candidates = build_model_candidates(start, end, fcst_hours, cycle, base_url, model=model, domain=domain)
+    base = base_url.rstrip("/")
+
+    # One listing per init time, on the longest prefix shared by that cycle's keys
+    cycle_prefixes = {}
+    for init, _, probe_url in candidates:
+        key = probe_url[len(base) + 1:]
+        cycle_prefixes.setdefault(init, []).append(key)
+    cycle_prefixes = {init: os.path.commonprefix(keys) for init, keys in cycle_prefixes.items()}
+    print(f"🔎 Listing {len(cycle_prefixes)} {model} cycles for {len(candidates)} expected files...")
+
+    # cycles whose every expected index is already cached need no listing at all
+    cached_cycles = set(cycle_prefixes)
+    for init, _, probe_url in candidates:
+        if not probe_url.endswith(".idx") or read_cached_idx(probe_url) is None:
+            cached_cycles.discard(init)
+
+    def _list(init):
+        if init in cached_cycles:
+            return init, None, None
+        try:
+            return init, list_s3_prefix(base, cycle_prefixes[init]), None
+        except (requests.exceptions.RequestException, ET.ParseError) as e:
+            return init, None, str(e)
+
+    listings = {}
+    errors = {}
+    if cycle_prefixes:
+        with ThreadPoolExecutor(max_workers=min(config.DISCOVERY_WORKERS, len(cycle_prefixes))) as executor:
+            for init, objects, error in executor.map(_list, list(cycle_prefixes)):
+                listings[init] = objects
+                errors[init] = error
 
-    # Download .idx file
-    idx_url = remote_url + ".idx"
-    r = requests.get(idx_url)
-    if not r.ok:
-        print(f'     ❌ Could not get index file: {idx_url} ({r.status_code} {r.reason})')
+    file_urls = []
+    report = {"missing": [], "failed": [], "objects": {}}
+    for init, full_url, probe_url in candidates:
+        objects = listings.get(init)
+        if init in cached_cycles:
+            file_urls.append(full_url)
+        elif objects is None:
+            print(f"⚠️ Error listing {cycle_prefixes[init]}: {errors[init]}")
+            report["failed"].append((probe_url, errors[init]))
+        elif probe_url[len(base) + 1:] in objects:
+            file_urls.append(full_url)
+            if full_url[len(base) + 1:] in objects:
+                report["objects"][full_url] = objects[full_url[len(base) + 1:]]
+        else:
+            print(f"⚠️ Missing: {probe_url} — not listed")
+            report["missing"].append((probe_url, "not listed"))
+    print(f"🔎 Found {len(file_urls)}/{len(candidates)} files "
+          f"({len(report['missing'])} missing, {len(report['failed'])} failed).")
+    if return_report:
+        return file_urls, report
+    return file_urls
+
+
+def coalesce_byte_ranges(ranges, max_gap=None):
+    """
+    Sort byte ranges and merge those separated by at most max_gap bytes.
+
+    Bytes inside a gap are downloaded but discarded, so the written subset holds
+    exactly the requested messages.
+
+    Returns:
+    - list[tuple] — (fetch_start, fetch_end or None, [(start, end or None), ...])
+    """
+    max_gap = config.RANGE_MERGE_GAP if max_gap is None else max_gap
+    groups = []
+    for start, end in sorted(ranges, key=lambda r: r[0]):
+        if groups:
+            fetch_start, fetch_end, members = groups[-1]
+            if fetch_end is None or start <= fetch_end + 1 + max_gap:
+                members.append((start, end))
+                if fetch_end is not None:
+                    new_end = None if end is None else max(fetch_end, end)
+                    groups[-1] = (fetch_start, new_end, members)
+                continue
+        groups.append((start, end, [(start, end)]))
+    return groups
+
+def _member_size(start, end):
+    return None if end is None else end - start + 1
+
+def _write_members(chunk, chunk_start, members, sinks, written):
+    """Write the parts of one downloaded chunk that fall inside each member range; returns the next position."""
+    chunk_end = chunk_start + len(chunk)
+    for i, (start, end) in enumerate(members):
+        stop = chunk_end if end is None else min(chunk_end, end + 1)
+        lo = max(chunk_start, start)
+        if lo < stop:
+            sinks[i].write(chunk[lo - chunk_start:stop - chunk_start])
+            written[i] += stop - lo
+    return chunk_end
+
+def _check_member_sizes(members, written):
+    for (start, end), n_bytes in zip(members, written):
+        expected = _member_size(start, end)
+        if (expected is not None and n_bytes != expected) or n_bytes == 0:
+            print(f"      ❌ Size mismatch for bytes {start}-{end if end is not None else ''}: got {n_bytes}")
+            return False
+    return True
+
+def _group_offsets(groups):
+    """Output offset of each merged group when its members are written back to back."""
+    offsets = []
+    offset = 0
+    for _, _, members in groups:
+        offsets.append(offset)
+        # only the final member of the final group can be open-ended
+        offset += sum(_member_size(start, end) or 0 for start, end in members)
+    return offsets
+
+def _stream_range_group(remote_url, group, sinks, chunk_size=None):
+    """
+    Stream one merged range, writing each member message to its sink (gap bytes are
+    skipped) and checking each member's size. Sinks may repeat (one file for all members).
+
+    Returns:
+    - int — bytes written, or None on failure
+    """
+    chunk_size = chunk_size or config.DOWNLOAD_CHUNK_SIZE
+    fetch_start, fetch_end, members = group
+    byte_range = f"{fetch_start}-{fetch_end}" if fetch_end is not None else f"{fetch_start}-"
+    written = [0] * len(members)
+    try:
+        with _host_semaphore(remote_url, config.DISCOVERY_PER_HOST):
+            with get_http_session().get(remote_url, headers={'Range': f'bytes={byte_range}'}, stream=True) as r:
+                if r.status_code not in (200, 206):
+                    print(f"      ❌ Failed to download byte range {byte_range}")
+                    return None
+                # a 200 means the server ignored the Range header and sent the whole object
+                position = fetch_start if r.status_code == 206 else 0
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    position = _write_members(chunk, position, members, sinks, written)
+                    if fetch_end is not None and position > fetch_end:
+                        break
+    except requests.exceptions.RequestException as e:
+        print(f"      ❌ Failed to download byte range {byte_range}: {e}")
+        return None
+    if not _check_member_sizes(members, written):
         return None
+    return sum(written)
 
-    lines = r.text.strip().split('\n')
-    matched_ranges = {}
+def _stream_range_group_to_file(remote_url, group, local_filename, out_offset):
+    with open(local_filename, 'r+b') as f_out:
+        f_out.seek(out_offset)
+        return _stream_range_group(remote_url, group, [f_out] * len(group[2]))
 
-    # Special handling for NBM QPF percentiles
-    if model == "nbmqmd" or model == 'nbmqmd_exp':
-        # Extract forecast hour from filename (e.g., f060)
-        base = os.path.basename(remote_url)
-        fcst_match = re.search(r"f(\d{3})", base)
-        if not fcst_match:
-            print("     ❌ Could not determine forecast hour from filename.")
-            return None
-        fcst_hour = int(fcst_match.group(1))
-        tr_end = fcst_hour
+def fetch_range_groups(remote_url, groups, local_filename, max_workers=None):
+    """
+    Stream merged range groups concurrently into local_filename.
+
+    Each group is written at its own precomputed offset, so peak memory per worker is
+    one DOWNLOAD_CHUNK_SIZE buffer regardless of message or file size.
+
+    Returns:
+    - int — total bytes written, or None if any request failed
+    """
+    max_workers = max_workers or config.RANGE_FETCH_WORKERS
+    offsets = _group_offsets(groups)
+    # create/truncate once so every worker can open it r+b
+    with open(local_filename, 'wb'):
+        pass
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(groups)))) as executor:
+        results = list(executor.map(
+            lambda item: _stream_range_group_to_file(remote_url, item[0], local_filename, item[1]),
+            zip(groups, offsets),
+        ))
+    if any(result is None for result in results):
+        Path(local_filename).unlink(missing_ok=True)
+        return None
+    return sum(results)
+
+def fetch_range_messages(remote_url, groups, max_workers=None):
+    """
+    Fetch merged range groups concurrently into memory, one buffer per GRIB message.
+
+    Returns:
+    - list[bytes] — messages in byte order, or None if any request failed
+    """
+    max_workers = max_workers or config.RANGE_FETCH_WORKERS
+    buffers = [[io.BytesIO() for _ in members] for _, _, members in groups]
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(groups)))) as executor:
+        results = list(executor.map(
+            lambda item: _stream_range_group(remote_url, item[0], item[1]),
+            zip(groups, buffers),
+        ))
+    if any(result is None for result in results):
+        return None
+    return [buf.getvalue() for group_buffers in buffers for buf in group_buffers]
+
+
+def stream_download(remote_url, local_filename, chunk_size=None, verify_checksum=None):
+    """
+    Download a whole object to disk in DOWNLOAD_CHUNK_SIZE pieces.
+
+    The byte count is checked against Content-Length and, when VERIFY_CHECKSUMS is on and
+    the ETag is a plain MD5 (single-part upload), the MD5 of the written bytes too.
+
+    Returns:
+    - str — local_filename, or None on failure
+    """
+    chunk_size = chunk_size or config.DOWNLOAD_CHUNK_SIZE
+    verify_checksum = config.VERIFY_CHECKSUMS if verify_checksum is None else verify_checksum
+    try:
+        with _host_semaphore(remote_url, config.DISCOVERY_PER_HOST):
+            with get_http_session().get(remote_url, stream=True) as r:
+                if r.status_code not in (200, 206):
+                    print(f"❌ Failed to download: {remote_url} ({r.status_code} {r.reason})")
+                    return None
+                expected_size = r.headers.get("Content-Length")
+                etag = (r.headers.get("ETag") or "").strip('"')
+                digest = hashlib.md5() if verify_checksum and etag and "-" not in etag else None
+                n_bytes = 0
+                with open(local_filename, 'wb') as f_out:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        f_out.write(chunk)
+                        n_bytes += len(chunk)
+                        if digest is not None:
+                            digest.update(chunk)
+    except requests.exceptions.RequestException as e:
+        print(f"❌ Exception downloading {remote_url}: {e}")
+        Path(local_filename).unlink(missing_ok=True)
+        return None
+    if expected_size is not None and n_bytes != int(expected_size):
+        print(f"❌ Size mismatch for {remote_url}: got {n_bytes}, expected {expected_size}")
+        Path(local_filename).unlink(missing_ok=True)
+        return None
+    if digest is not None and digest.hexdigest() != etag:
+        print(f"❌ Checksum mismatch for {remote_url}")
+        Path(local_filename).unlink(missing_ok=True)
+        return None
+    return local_filename
+
+
+IDX_PERCENTILES = (5, 10, 25, 50, 75, 90, 95)
+IDX_PERCENTILE_RE = re.compile(r"(\d+)% level")
+ACCUM_INTERVALS = {"snow6hr": 6, "snow24hr": 24, "snow48hr": 48, "snow72hr": 72}
+
+
+class IdxTable:
+    """
+    Columnar view of a wgrib2 .idx file, parsed once per download.
+
+    Each field is a numpy array indexed by message: msg, start, end (-1 for the last
+    message, which runs to EOF), var, level, timerange, percentile (-1 when the
+    message is not a percentile) and the raw line.
+    """
+
+    def __init__(self, idx_text):
+        lines = [line for line in idx_text.strip().split('\n') if line.strip()]
+        fields = [line.split(':') for line in lines]
+        self.line = np.array(lines, dtype=str)
+        self.msg = np.array([f[0] for f in fields], dtype=str)
+        self.start = np.array([int(f[1]) for f in fields], dtype=np.int64)
+        self.end = np.full(len(lines), -1, dtype=np.int64)
+        self.end[:-1] = self.start[1:] - 1
+        self.var = np.array([f[3] if len(f) > 3 else '' for f in fields], dtype=str)
+        self.level = np.array([f[4] if len(f) > 4 else '' for f in fields], dtype=str)
+        self.timerange = np.array([f[5] if len(f) > 5 else '' for f in fields], dtype=str)
+        percentile = []
+        for f in fields:
+            m = IDX_PERCENTILE_RE.match(f[-1].strip())
+            percentile.append(int(m.group(1)) if m else -1)
+        self.percentile = np.array(percentile, dtype=np.int16)
+
+    def __len__(self):
+        return len(self.line)
+
+    def byte_ranges(self, rows):
+        """
+        Returns:
+        - list[tuple] — (start, end or None) for each selected row, in file order
+        """
+        return [(int(self.start[i]), int(self.end[i]) if self.end[i] >= 0 else None)
+                for i in np.sort(rows)]
+
+
+class SelectionPlan:
+    """
+    Precompiled .idx selection for one (model, element, forecast hour).
+
+    Search strings like ':WIND:10 m above' compile to a var match plus a level
+    prefix; a trailing ':' (':APCP:surface:') makes the level exact. Anything else
+    falls back to a substring match on the raw line.
+    """
+
+    def __init__(self, search_strings, timerange=None, timerange_re=None,
+                 percentiles=None, exclude_phrases=(), require_all=False):
+        self.terms = [self._compile_term(s) for s in search_strings]
+        self.timerange = timerange
+        self.timerange_re = timerange_re
+        self.percentiles = np.array(percentiles) if percentiles else None
+        self.exclude_phrases = tuple(exclude_phrases)
+        self.require_all = require_all
+
+    @staticmethod
+    def _compile_term(search_str):
+        tokens = search_str.split(':')
+        if (len(tokens) in (3, 4) and tokens[0] == '' and tokens[1] and tokens[2]
+                and (len(tokens) == 3 or tokens[3] == '')):
+            return (search_str, tokens[1], tokens[2], len(tokens) == 4)
+        return (search_str, None, None, None)
+
+    def select(self, table):
+        """
+        Match every term against the table in one vectorized pass per term.
+
+        Returns:
+        - list[tuple] — (start, end or None) byte ranges of the matched messages
+        - set — search strings that matched at least one message
+        """
+        keep = np.ones(len(table), dtype=bool)
+        if self.timerange is not None:
+            keep &= np.char.startswith(table.timerange, self.timerange)
+        if self.percentiles is not None:
+            keep &= np.isin(table.percentile, self.percentiles)
+
+        term_hits = {}
+        for search_str, var, level, exact in self.terms:
+            if var is None:
+                hits = np.char.find(table.line, search_str) >= 0
+            elif exact:
+                hits = (table.var == var) & (table.level == level)
+            else:
+                hits = (table.var == var) & np.char.startswith(table.level, level)
+            term_hits[search_str] = keep & hits
+
+        rows = np.zeros(len(table), dtype=bool)
+        for hits in term_hits.values():
+            rows |= hits
+        # substring and regex checks only run on the few candidate rows
+        candidates = np.flatnonzero(rows)
+        if len(candidates) and (self.exclude_phrases or self.timerange_re is not None):
+            ok = np.ones(len(candidates), dtype=bool)
+            for phrase in self.exclude_phrases:
+                ok &= np.char.find(table.line[candidates], phrase) < 0
+            if self.timerange_re is not None:
+                ok &= np.array([self.timerange_re.search(f":{tr}:") is not None
+                                for tr in table.timerange[candidates]], dtype=bool)
+            rows[candidates[~ok]] = False
+
+        matched_vars = {s for s, hits in term_hits.items() if (hits & rows).any()}
+        return table.byte_ranges(np.flatnonzero(rows)), matched_vars
+
+
+def _require_hour(fcst_hour):
+    if fcst_hour is None:
+        raise ValueError("Could not determine forecast hour from filename.")
+    return fcst_hour
+
+@lru_cache(maxsize=256)
+def selection_plan(model, element, fcst_hour, search_strings, exclude_phrases=(),
+                   require_all_matches=True):
+    """
+    Compile (and cache) the .idx selection for one model/element/forecast hour.
+
+    - nbmqmd: percentile fields for the element's time range
+    - hrrr/urma accumulations: the run-total accumulation ending at fcst_hour
+    - nbm probabilistic snow: percentile fields of the annotated accumulation
+    - everything else: plain search-string matches, optionally requiring all of them
+
+    Returns:
+    - SelectionPlan — or None when no accumulation ends at fcst_hour
+    """
+    timerange = timerange_re = percentiles = None
+    require_all = False
+    if model in ("nbmqmd", "nbmqmd_exp"):
+        fcst_hour = _require_hour(fcst_hour)
         if element == "precip24hr":
             accum_alts = labels_for_day_accum(fcst_hour)
             if not accum_alts:
-                # no 24-h accumulation at t=0
-                print("     ℹ️ No 24-h accumulation at forecast hour 0")
                 return None
-            accum_str = accum_alts[0]
-        elif element == 'precip6hr':
-            tr_start = fcst_hour - 6
-            accum_str = f"{tr_start}-{tr_end} hour acc fcst"
+            timerange = accum_alts[0]
+        elif element == "precip6hr":
+            timerange = f"{fcst_hour - 6}-{fcst_hour} hour acc fcst"
         elif element == "maxt":
-            tr_start = fcst_hour - 18
-            accum_str = f"{tr_start}-{tr_end} hour max fcst"
+            timerange = f"{fcst_hour - 18}-{fcst_hour} hour max fcst"
         elif element == "mint":
-            tr_start = fcst_hour - 18
-            accum_str = f"{tr_start}-{tr_end} hour min fcst"
-        elif element == "Wind":
-            tr_start = tr_end
-            accum_str = f"{tr_end} hour fcst"
-        elif element == "Gust":
-            tr_start = tr_end
-            accum_str = f"{tr_end} hour fcst"
+            timerange = f"{fcst_hour - 18}-{fcst_hour} hour min fcst"
+        elif element in ("Wind", "Gust"):
+            timerange = f"{fcst_hour} hour fcst"
         else:
-            raise NotImplementedError(f"Adjust your time step for {element} and {model} in download_subset in utils.py")
-        # Target percentiles
-        # With this:
-        target_perc_values = {5, 10, 25, 50, 75, 90, 95}
-        # Compile search patterns
-        search_exprs = [re.escape(s) for s in search_strings]
-        search_pattern = re.compile("|".join(search_exprs))
-        for n, line in enumerate(lines, start=1):
-            if exclude_phrases and any(phrase in line for phrase in exclude_phrases):
-                continue
-            if not search_pattern.search(line):
-                continue
-            if accum_str not in line:
-                continue
-            #if not any(level in line for level in target_levels):
-            #    continue
-            last_token = line.split(":")[-1].strip()
-            match = re.match(r"(\d+)% level", last_token)
-            if not match or int(match.group(1)) not in target_perc_values:
-                continue
-            parts = line.split(':')
-            rangestart = int(parts[1])
+            raise NotImplementedError(f"Adjust your time step for {element} and {model} in selection_plan in utils.py")
+        percentiles = IDX_PERCENTILES
+    elif model in ("hrrr", "urma") and element in ("precip6hr", "precip24hr", "snow6hr"):
+        fcst_hour = _require_hour(fcst_hour)
+        day_labels = {0: "0-0 day acc fcst", 24: "0-1 day acc fcst", 48: "0-2 day acc fcst"}
+        timerange = day_labels.get(fcst_hour, f"0-{fcst_hour} hour acc fcst")
+    elif model in ("nbm", "nbm_exp") and element in config.PROBABILISTIC_ELEMENTS[model]:
+        fcst_hour = _require_hour(fcst_hour)
+        if element not in ACCUM_INTERVALS:
+            raise NotImplementedError(f"Adjust your time step for {element} and {model} in selection_plan in utils.py")
+        timerange_re = idx_accum_re(fcst_hour, interval=ACCUM_INTERVALS[element])
+        if timerange_re is None:
+            return None
+        percentiles = IDX_PERCENTILES
+    elif model in ("hrrr", "urma", "nbm", "nbm_exp"):
+        if model in ("nbm", "nbm_exp"):
+            _require_hour(fcst_hour)
+        require_all = require_all_matches
+    else:
+        raise NotImplementedError(f"No .idx selection defined for {model} in selection_plan in utils.py")
+    return SelectionPlan(search_strings, timerange=timerange, timerange_re=timerange_re,
+                         percentiles=percentiles, exclude_phrases=exclude_phrases,
+                         require_all=require_all)
 
-            if n < len(lines):
-                parts_next = lines[n].split(':')
-                rangeend = int(parts_next[1]) - 1
-            else:
-                rangeend = ''
+def download_subset(remote_url, local_filename, search_strings, model, element,
+                    require_all_matches=True,
+                    required_phrases=None,
+                    exclude_phrases=None,
+                    in_memory=False):
+    """
+    Download a subset of a GRIB2 file based on .idx entries matching search_strings.
 
-            byte_range = f'{rangestart}-{rangeend}' if rangeend else f'{rangestart}-'
-            matched_ranges[byte_range] = line
+    The .idx is parsed once into an IdxTable and matched with the cached
+    SelectionPlan for (model, element, forecast hour).
+    With in_memory=True nothing is written: the matched GRIB messages are returned
+    as a list of bytes (local_filename may be None).
+    """
+    print(f"  > Downloading subset for {os.path.basename(remote_url)}")
+    if not in_memory:
+        os.makedirs(os.path.dirname(local_filename), exist_ok=True)
 
-    if model in ["hrrr", "urma"] and element in ["precip6hr", "precip24hr", "snow6hr"]:
-        base = os.path.basename(remote_url)
-        try:
-            fcst_hour = parse_forecast_hour(base)
-        except ValueError:
-            print("     ❌ Could not determine forecast hour from filename.")
-            return None
-        tr_end = fcst_hour
-        if element == 'precip24hr':
-            tr_start = fcst_hour - 24
-            if tr_end == 24:
-                accum_str = f"0-1 day acc fcst"
-            elif tr_end == 48:
-                accum_str = f"0-2 day acc fcst"
-            elif tr_end == 0:
-                accum_str = f"0-0 day acc fcst"
-            else:
-                accum_str = f"0-{tr_end} hour acc fcst"
-        elif element == 'precip6hr':
-            tr_start = fcst_hour - 6
-            if tr_end == 24:
-                accum_str = f"0-1 day acc fcst"
-            elif tr_end == 48:
-                accum_str = f"0-2 day acc fcst"
-            elif tr_end == 0:
-                accum_str = f"0-0 day acc fcst"
-            else:
-                accum_str = f"0-{tr_end} hour acc fcst"
-        elif element == 'snow6hr':
-            tr_start = fcst_hour - 6
-            if tr_end == 24:
-                accum_str = f"0-1 day acc fcst"
-            elif tr_end == 48:
-                accum_str = f"0-2 day acc fcst"
-            elif tr_end == 0:
-                accum_str = f"0-0 day acc fcst"
-            else:
-                accum_str = f"0-{tr_end} hour acc fcst"
-        else:
-            raise NotImplementedError(f"Adjust your time step for {element} and {model} in download_subset in utils.py")
-        # Compile search patterns
-        search_exprs = [re.escape(s) for s in search_strings]
-        search_pattern = re.compile("|".join(search_exprs))
-        for n, line in enumerate(lines, start=1):
-            if exclude_phrases and any(phrase in line for phrase in exclude_phrases):
-                continue
-            if not search_pattern.search(line):
-                continue
-            if accum_str not in line:
-                continue
-            parts = line.split(':')
-            rangestart = int(parts[1])
+    # Download .idx file (or reuse the copy discovery already cached)
+    idx_url = remote_url + ".idx"
+    idx_text, status, reason = _fetch_idx(idx_url)
+    if idx_text is None:
+        print(f'     ❌ Could not get index file: {idx_url} ({status} {reason})')
+        return None
 
-            if n < len(lines):
-                parts_next = lines[n].split(':')
-                rangeend = int(parts_next[1]) - 1
-            else:
-                rangeend = ''
+    ranges = select_subset_ranges(remote_url, idx_text, search_strings, model, element,
+                                  require_all_matches=require_all_matches,
+                                  exclude_phrases=exclude_phrases)
+    if ranges is None:
+        return None
 
-            byte_range = f'{rangestart}-{rangeend}' if rangeend else f'{rangestart}-'
-            matched_ranges[byte_range] = line
+    # Download GRIB subset: merge neighbouring messages into as few range requests as possible
+    groups = coalesce_byte_ranges(ranges)
+    if in_memory:
+        messages = fetch_range_messages(remote_url, groups)
+        if messages is not None:
+            print(f'      ✅ Downloaded [{len(ranges)}] fields in {len(groups)} requests from {os.path.basename(remote_url)} into memory')
+        return messages
+    if fetch_range_groups(remote_url, groups, local_filename) is None:
+        return None
 
-    if model in ["hrrr", "urma"] and element not in ["precip6hr", "precip24hr", "snow6hr"]:
-        # Generic logic for other models: just match search strings
-        exprs = {s: re.compile(re.escape(s)) for s in search_strings}
-        matched_vars = set()
+    print(f'      ✅ Downloaded [{len(ranges)}] fields in {len(groups)} requests from {os.path.basename(remote_url)} → {local_filename}')
+    return local_filename if os.path.exists(local_filename) else None
 
-        for n, line in enumerate(lines, start=1):
-            if exclude_phrases and any(phrase in line for phrase in exclude_phrases):
-                continue
+def select_subset_ranges(remote_url, idx_text, search_strings, model, element,
+                         require_all_matches=True, exclude_phrases=None):
+    """
+    Pick the byte ranges of the messages download_subset should fetch from idx_text.
 
-            for search_str, expr in exprs.items():
-                if expr.search(line):
-                    matched_vars.add(search_str)
-                    parts = line.split(':')
-                    rangestart = int(parts[1])
-                    if n < len(lines):
-                        parts_next = lines[n].split(':')
-                        rangeend = int(parts_next[1]) - 1
-                    else:
-                        rangeend = ''
-                    byte_range = f'{rangestart}-{rangeend}' if rangeend else f'{rangestart}-'
-                    matched_ranges[byte_range] = line
+    Returns:
+    - list[tuple] — (start, end or None) in file order, or None if nothing usable matched
+    """
+    table = IdxTable(idx_text)
+    try:
+        fcst_hour = parse_forecast_hour(remote_url)
+    except ValueError:
+        fcst_hour = None
+    try:
+        plan = selection_plan(model, element, fcst_hour, tuple(search_strings),
+                              tuple(exclude_phrases or ()), require_all_matches)
+    except ValueError as e:
+        print(f"     ❌ {e}")
+        return None
+    if plan is None:
+        print(f"     ℹ️ No {element} accumulation available at forecast hour {fcst_hour}")
+        return None
+
+    ranges, matched_vars = plan.select(table)
+    if plan.require_all and len(matched_vars) != len(search_strings):
+        print(f'      ⚠️ Not all variables matched! Found: {matched_vars}. Skipping {remote_url}.')
+        return None
+    if not ranges:
+        print(f'      ❌ No matches found for {search_strings} for {remote_url}')
+        return None
+    return ranges
+
+class AsyncDownloader:
+    """
+    asyncio download engine for model GRIB subsets.
+
+    One aiohttp session holds a connection pool per host. A global semaphore and a
+    per-host semaphore cap requests in flight (ASYNC_MAX_CONCURRENCY /
+    ASYNC_PER_HOST), so hundreds of range requests can be outstanding without a
+    thread each. Transient failures (RETRY_STATUSES, connection errors, timeouts)
+    are retried up to MAX_RETRIES times with full-jitter exponential backoff.
+
+    Use as `async with AsyncDownloader() as dl:`; the coroutines mirror the
+    blocking helpers (download_subset, stream_download) and return the same values.
+    """
 
-        if require_all_matches and len(matched_vars) != len(search_strings):
-            print(f'      ⚠️ Not all variables matched! Found: {matched_vars}. Skipping {remote_url}.')
+    def __init__(self, max_concurrency=None, per_host=None, max_retries=None,
+                 timeout=None, chunk_size=None):
+        self.max_concurrency = max_concurrency or config.ASYNC_MAX_CONCURRENCY
+        self.per_host = per_host or config.ASYNC_PER_HOST
+        self.max_retries = config.MAX_RETRIES if max_retries is None else max_retries
+        self.timeout = timeout or config.ASYNC_TIMEOUT
+        self.chunk_size = chunk_size or config.DOWNLOAD_CHUNK_SIZE
+        self._session = None
+        self._limit = None
+        self._host_limits = {}
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, limit_per_host=self.per_host)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        self._limit = asyncio.Semaphore(self.max_concurrency)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._session.close()
+
+    def _host_limit(self, url):
+        host = urlparse(url).netloc
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self.per_host)
+        return self._host_limits[host]
+
+    async def _request(self, url, handler, headers=None):
+        """
+        GET url under the concurrency limits and hand the response to `handler`.
+
+        The handler must be safe to re-run, since a body that fails mid-stream is retried.
+
+        Returns:
+        - (handler result or None, status_code or None, reason/error text)
+        """
+        status, reason = None, None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(random.uniform(0, config.INITIAL_WAIT * 2 ** (attempt - 1)))
+            try:
+                async with self._limit, self._host_limit(url):
+                    async with self._session.get(url, headers=headers) as r:
+                        status, reason = r.status, r.reason
+                        if r.status in (200, 206):
+                            return await handler(r), status, reason
+                        if r.status not in RETRY_STATUSES:
+                            return None, status, reason
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status, reason = None, str(e) or type(e).__name__
+        return None, status, reason
+
+    async def fetch_idx(self, idx_url):
+        """Async _fetch_idx: same on-disk cache, same (text, status, reason) result."""
+        text = read_cached_idx(idx_url)
+        if text is not None:
+            return text, 200, "cached"
+
+        async def read_text(r):
+            return await r.text()
+
+        text, status, reason = await self._request(idx_url, read_text)
+        if text is not None:
+            write_cached_idx(idx_url, text)
+        return text, status, reason
+
+    async def _fetch_group(self, remote_url, group, make_sinks):
+        """Async _stream_range_group; make_sinks() is called once per attempt and must reset the sinks."""
+        fetch_start, fetch_end, members = group
+        byte_range = f"{fetch_start}-{fetch_end}" if fetch_end is not None else f"{fetch_start}-"
+
+        async def write_group(r):
+            sinks = make_sinks()
+            written = [0] * len(members)
+            # a 200 means the server ignored the Range header and sent the whole object
+            position = fetch_start if r.status == 206 else 0
+            async for chunk in r.content.iter_chunked(self.chunk_size):
+                position = _write_members(chunk, position, members, sinks, written)
+                if fetch_end is not None and position > fetch_end:
+                    break
+            return written
+
+        written, status, reason = await self._request(
+            remote_url, write_group, headers={'Range': f'bytes={byte_range}'})
+        if written is None:
+            print(f"      ❌ Failed to download byte range {byte_range} ({status} {reason})")
             return None
-    if model in ["nbm", "nbm_exp"] and element not in config.PROBABILISTIC_ELEMENTS[model]:
-        # Extract forecast hour from filename (e.g., f060)
-        base = os.path.basename(remote_url)
-        fcst_match = re.search(r"f(\d{3})", base)
-        if not fcst_match:
-            print("     ❌ Could not determine forecast hour from filename.")
+        if not _check_member_sizes(members, written):
             return None
-        fcst_hour = int(fcst_match.group(1))
-        # Generic logic for other models: just match search strings
-        exprs = {s: re.compile(re.escape(s)) for s in search_strings}
-        matched_vars = set()
+        return sum(written)
 
-        for n, line in enumerate(lines, start=1):
-            if exclude_phrases and any(phrase in line for phrase in exclude_phrases):
-                continue
+    async def fetch_range_groups(self, remote_url, groups, local_filename):
+        """Async fetch_range_groups: every group streams to its own offset of local_filename."""
+        # create/truncate once; each group then gets its own handle so interleaved
+        # writes never share a file position
+        with open(local_filename, 'wb'):
+            pass
+        handles = []
 
-            for search_str, expr in exprs.items():
-                if expr.search(line):
-                    matched_vars.add(search_str)
-                    parts = line.split(':')
-                    rangestart = int(parts[1])
-                    if n < len(lines):
-                        parts_next = lines[n].split(':')
-                        rangeend = int(parts_next[1]) - 1
-                    else:
-                        rangeend = ''
-                    byte_range = f'{rangestart}-{rangeend}' if rangeend else f'{rangestart}-'
-                    matched_ranges[byte_range] = line
-
-        if require_all_matches and len(matched_vars) != len(search_strings):
-            print(f'      ⚠️ Not all variables matched! Found: {matched_vars}. Skipping {remote_url}.')
-            return None 
-
-    if model in ["nbm", "nbm_exp"] and element in config.PROBABILISTIC_ELEMENTS[model]:
-        # Extract forecast hour from filename (e.g., f060)
-        base = os.path.basename(remote_url)
-        fcst_match = re.search(r"f(\d{3})", base)
-        if not fcst_match:
-            print("     ❌ Could not determine forecast hour from filename.")
+        def sinks_at(offset, n_members):
+            handle = open(local_filename, 'r+b')
+            handles.append(handle)
+
+            def make_sinks():
+                handle.seek(offset)
+                return [handle] * n_members
+            return make_sinks
+
+        try:
+            results = await asyncio.gather(*[
+                self._fetch_group(remote_url, group, sinks_at(offset, len(group[2])))
+                for group, offset in zip(groups, _group_offsets(groups))
+            ])
+        finally:
+            for handle in handles:
+                handle.close()
+        if any(result is None for result in results):
+            Path(local_filename).unlink(missing_ok=True)
+            return None
+        return sum(results)
+
+    async def fetch_range_messages(self, remote_url, groups):
+        """Async fetch_range_messages: one bytes object per GRIB message, in byte order."""
+        buffers = [None] * len(groups)
+
+        def sinks_for(i, n_members):
+            def make_sinks():
+                buffers[i] = [io.BytesIO() for _ in range(n_members)]
+                return buffers[i]
+            return make_sinks
+
+        results = await asyncio.gather(*[
+            self._fetch_group(remote_url, group, sinks_for(i, len(group[2])))
+            for i, group in enumerate(groups)
+        ])
+        if any(result is None for result in results):
+            return None
+        return [buf.getvalue() for group_buffers in buffers for buf in group_buffers]
+
+    async def download_subset(self, remote_url, local_filename, search_strings, model, element,
+                              require_all_matches=True, exclude_phrases=None, in_memory=False):
+        """Async download_subset, sharing its .idx cache and selection plans."""
+        print(f"  > Downloading subset for {os.path.basename(remote_url)}")
+        if not in_memory:
+            os.makedirs(os.path.dirname(local_filename), exist_ok=True)
+
+        idx_url = remote_url + ".idx"
+        idx_text, status, reason = await self.fetch_idx(idx_url)
+        if idx_text is None:
+            print(f'     ❌ Could not get index file: {idx_url} ({status} {reason})')
+            return None
+
+        ranges = select_subset_ranges(remote_url, idx_text, search_strings, model, element,
+                                      require_all_matches=require_all_matches,
+                                      exclude_phrases=exclude_phrases)
+        if ranges is None:
             return None
-        fcst_hour = int(fcst_match.group(1))
-
-        if element == "snow24hr":
-            accum_rx = idx_accum_re(fcst_hour, interval=24)
-        elif element == "snow48hr":
-            accum_rx = idx_accum_re(fcst_hour, interval=48)
-        elif element == "snow72hr":
-            accum_rx = idx_accum_re(fcst_hour, interval=72)
-        elif element == "snow6hr":
-            accum_rx = idx_accum_re(fcst_hour, interval=6)
-        else:
-            raise NotImplementedError(...)
 
-        if accum_rx is None:
-            print(f"     ℹ️ No {element} accumulation available at forecast hour {fcst_hour}")
+        groups = coalesce_byte_ranges(ranges)
+        if in_memory:
+            messages = await self.fetch_range_messages(remote_url, groups)
+            if messages is not None:
+                print(f'      ✅ Downloaded [{len(ranges)}] fields in {len(groups)} requests from {os.path.basename(remote_url)} into memory')
+            return messages
+        if await self.fetch_range_groups(remote_url, groups, local_filename) is None:
             return None
 
-        target_perc_values = {5, 10, 25, 50, 75, 90, 95}
+        print(f'      ✅ Downloaded [{len(ranges)}] fields in {len(groups)} requests from {os.path.basename(remote_url)} → {local_filename}')
+        return local_filename if os.path.exists(local_filename) else None
+
+    async def stream_download(self, remote_url, local_filename, verify_checksum=None):
+        """Async stream_download, with the same Content-Length and optional ETag checks."""
+        verify_checksum = config.VERIFY_CHECKSUMS if verify_checksum is None else verify_checksum
+
+        async def write_file(r):
+            expected_size = r.headers.get("Content-Length")
+            etag = (r.headers.get("ETag") or "").strip('"')
+            digest = hashlib.md5() if verify_checksum and etag and "-" not in etag else None
+            n_bytes = 0
+            with open(local_filename, 'wb') as f_out:
+                async for chunk in r.content.iter_chunked(self.chunk_size):
+                    f_out.write(chunk)
+                    n_bytes += len(chunk)
+                    if digest is not None:
+                        digest.update(chunk)
+            return n_bytes, expected_size, etag, digest
+
+        result, status, reason = await self._request(remote_url, write_file)
+        if result is None:
+            print(f"❌ Failed to download: {remote_url} ({status} {reason})")
+            Path(local_filename).unlink(missing_ok=True)
+            return None
+        n_bytes, expected_size, etag, digest = result
+        if expected_size is not None and n_bytes != int(expected_size):
+            print(f"❌ Size mismatch for {remote_url}: got {n_bytes}, expected {expected_size}")
+            Path(local_filename).unlink(missing_ok=True)
+            return None
+        if digest is not None and digest.hexdigest() != etag:
+            print(f"❌ Checksum mismatch for {remote_url}")
+            Path(local_filename).unlink(missing_ok=True)
+            return None
+        return local_filename
 
-        search_exprs = [re.escape(s) for s in search_strings]  # e.g., ["ASNOW", "surface"]
-        search_pattern = re.compile("|".join(search_exprs))
 
-        matched_ranges = {}
-        for n, line in enumerate(lines, start=1):
-            if exclude_phrases and any(p in line for p in exclude_phrases):
-                continue
-            if not search_pattern.search(line):
-                continue
-            # >>> strict match of annotated accumulation text <<<
-            if not accum_rx.search(line):
-                continue
+def print_download_progress(done, total, remote_url, ok):
+    print(f"{'✅' if ok else '❌'} Downloaded {done}/{total} files.")
 
-            # keep only desired percentiles
-            last_token = line.split(":")[-1].strip()
-            m = re.match(r"(\d+)% level", last_token)
-            if not m or int(m.group(1)) not in target_perc_values:
-                continue
+def download_files_async(file_urls, download_one, progress=print_download_progress,
+                         max_files=None, **limits):
+    """
+    Run `await download_one(downloader, remote_url)` for every URL on one event loop.
 
-            parts = line.split(":")
-            rangestart = int(parts[1])
-            if n < len(lines):
-                parts_next = lines[n].split(":")
-                rangeend = int(parts_next[1]) - 1
-            else:
-                rangeend = ""
-            byte_range = f"{rangestart}-{rangeend}" if rangeend else f"{rangestart}-"
-            matched_ranges[byte_range] = line
-    # Check if anything was found
-    if not matched_ranges:
-        print(f'      ❌ No matches found for {search_strings} for {remote_url} and {local_filename}')
-        return None
+    download_one returns (remote_url, payload); progress(done, total, remote_url, ok)
+    is called as each file finishes. max_files caps how many download_one calls run
+    at once (default: all). Extra keyword arguments go to AsyncDownloader.
 
-    # Download GRIB subset
-    with open(local_filename, 'wb') as f_out:
-        for byteRange in matched_ranges.keys():
-            r = requests.get(remote_url, headers={'Range': f'bytes=' + byteRange})
-            if r.status_code in (200, 206):
-                f_out.write(r.content)
-            else:
-                print(f"      ❌ Failed to download byte range {byteRange}")
-                return None
+    Returns:
+    - list[tuple] — (remote_url, payload) in completion order
+    """
+    async def run_all():
+        file_slots = asyncio.Semaphore(max_files or max(1, len(file_urls)))
 
-    print(f'      ✅ Downloaded [{len(matched_ranges)}] fields from {os.path.basename(remote_url)} → {local_filename}')
-    return local_filename if os.path.exists(local_filename) else None
+        async def bounded(dl, url):
+            async with file_slots:
+                return await download_one(dl, url)
+
+        async with AsyncDownloader(**limits) as dl:
+            tasks = [asyncio.ensure_future(bounded(dl, url)) for url in file_urls]
+            results = []
+            for done, task in enumerate(asyncio.as_completed(tasks), 1):
+                remote_url, payload = await task
+                results.append((remote_url, payload))
+                if progress is not None:
+                    progress(done, len(file_urls), remote_url, bool(payload))
+            return results
+
+    return asyncio.run(run_all())
 
 def parse_date_and_time_from_url(remote_url, model):
     url_parts = remote_url.split('/')
@@ -794,7 +2073,453 @@ def add_interval_precip_from_total(
             .reset_index(drop=True)
         )
 
-def extract_model_subset_parallel(file_urls, station_df, search_strings, element, model, config):
+# cfgrib filter_by_keys used for URMA analyses (10 m instantaneous fields only)
+URMA_FILTER_KEYS = {"typeOfLevel": "heightAboveGround", "stepType": "instant", "level": 10}
+
+def iter_grib_handles(payload):
+    """eccodes handles for a GRIB file path or a list of in-memory messages; released after each step."""
+    if isinstance(payload, (str, Path)):
+        with open(payload, "rb") as f:
+            while True:
+                gid = eccodes.codes_grib_new_from_file(f)
+                if gid is None:
+                    break
+                try:
+                    yield gid
+                finally:
+                    eccodes.codes_release(gid)
+    else:
+        for message in payload:
+            gid = eccodes.codes_new_from_message(message)
+            try:
+                yield gid
+            finally:
+                eccodes.codes_release(gid)
+
+def _grib_message_values(gid):
+    """2D float32 field of one message, NaN where the bitmap is missing (as cfgrib decodes it)."""
+    shape = (eccodes.codes_get(gid, "Nj"), eccodes.codes_get(gid, "Ni"))
+    values = eccodes.codes_get_values(gid)
+    if eccodes.codes_get(gid, "bitmapPresent"):
+        values[values == eccodes.codes_get(gid, "missingValue")] = np.nan
+    return values.astype(np.float32).reshape(shape)
+
+def _grib_message_grid(gid, layout="eccodes"):
+    """Grid id/keys of one message and its lat/lon from the grid geometry cache."""
+    shape = (eccodes.codes_get(gid, "Nj"), eccodes.codes_get(gid, "Ni"))
+    grid_keys = {k: eccodes.codes_get(gid, k) for k in GRID_DEFINITION_KEYS if eccodes.codes_is_defined(gid, k)}
+
+    def compute():
+        lats = eccodes.codes_get_array(gid, "latitudes").reshape(shape)
+        lons = eccodes.codes_get_array(gid, "longitudes").reshape(shape)
+        return lats, (lons - 360 if layout == "west" else lons)
+    lats, lons = grid_geometry(grid_keys.get("md5Section3"), compute, layout=layout)
+    return {"grid_id": grid_keys.get("md5Section3"), "grid_keys": grid_keys, "shape": shape,
+            "lats": lats, "lons": lons}
+
+def _grib_message_valid_time(gid):
+    return np.datetime64(datetime.strptime(
+        f"{eccodes.codes_get(gid, 'validityDate')}{eccodes.codes_get(gid, 'validityTime'):04d}",
+        "%Y%m%d%H%M",
+    ), "ns")
+
+def read_grib_fields(payload, filter_keys=None):
+    """
+    Walk GRIB messages with eccodes and return their fields as numpy arrays, without the
+    cfgrib index and xarray coordinates an xr.open_dataset builds for every file.
+
+    payload is a GRIB file path or a list of in-memory messages. Fields are keyed by
+    cfVarName, the eccodes shortName/level mapping cfgrib names its variables with (and
+    HERBIE_RENAME_MAP is keyed by); the first message of each name wins. filter_keys
+    skips messages whose eccodes keys differ, like cfgrib's filter_by_keys. Values are
+    float32 like cfgrib's, NaN where the bitmap is missing; lat/lon come from the grid
+    geometry cache.
+
+    Returns:
+    - dict — fields {name: 2D array}, valid_time (datetime64), grid_id (md5Section3),
+      grid_keys (GRID_DEFINITION_KEYS), lats, lons; None when no message matched
+    """
+    fields = {}
+    grid = None
+    for gid in iter_grib_handles(payload):
+        if filter_keys and any(eccodes.codes_get(gid, key, type(value)) != value
+                               for key, value in filter_keys.items()):
+            continue
+        name = eccodes.codes_get(gid, "cfVarName")
+        if name in fields:
+            continue
+        fields[name] = _grib_message_values(gid)
+        if grid is None:
+            grid = _grib_message_grid(gid)
+            grid.pop("shape")
+            grid["valid_time"] = _grib_message_valid_time(gid)
+    if grid is None:
+        return None
+    return {"fields": fields, **grid}
+
+def read_grib_station_steps(payload, name, station_points, layout="eccodes"):
+    """
+    Decode the forecast steps of one variable a message at a time, keeping only the
+    station values: peak memory is a single 2D field instead of the (steps x ny x nx)
+    cube. station_points(grid) is called once with the first message's grid (see
+    _grib_message_grid) and returns the field -> station values function. The first
+    message of each step wins; steps come back sorted like cfgrib's step dimension.
+
+    Returns:
+    - dict — steps (forecast hours), valid_time (datetime64), points (steps x stations),
+      grid; None when no message of that name was found
+    """
+    by_step = {}
+    grid = extract = None
+    for gid in iter_grib_handles(payload):
+        if eccodes.codes_get(gid, "cfVarName") != name:
+            continue
+        eccodes.codes_set(gid, "stepUnits", 1)
+        step = eccodes.codes_get(gid, "endStep")
+        if step in by_step:
+            continue
+        if grid is None:
+            grid = _grib_message_grid(gid, layout=layout)
+            extract = station_points(grid)
+        by_step[step] = (_grib_message_valid_time(gid), np.asarray(extract(_grib_message_values(gid))))
+    if grid is None:
+        return None
+    steps = sorted(by_step)
+    return {
+        "steps": np.array(steps, dtype=int),
+        "valid_time": np.array([by_step[s][0] for s in steps], dtype="datetime64[ns]"),
+        "points": np.stack([by_step[s][1] for s in steps]),
+        "grid": grid,
+    }
+
+def grib_fields_from_dataset(ds):
+    """The read_grib_fields layout for a cfgrib-opened dataset (GRIB_READER="cfgrib")."""
+    grid_id = grid_id_from_dataset(ds)
+    lats, lons = grid_geometry(grid_id, lambda: (ds.latitude.values, ds.longitude.values))
+    return {
+        "fields": {name: ds[name].values for name in ds.data_vars},
+        "valid_time": ds.valid_time.values,
+        "grid_id": grid_id,
+        "grid_keys": grid_keys_from_dataset(ds),
+        "lats": lats,
+        "lons": lons,
+    }
+
+@contextmanager
+def open_pygrib_messages(payload):
+    """Yield pygrib messages from a subset file path or from a list of in-memory messages."""
+    if isinstance(payload, (str, Path)):
+        with pygrib.open(str(payload)) as grbs:
+            yield grbs
+    else:
+        yield [pygrib.fromstring(message) for message in payload]
+
+def _station_extractor(context, lats, lons, grid_id, grid_keys, shape):
+    """
+    Field -> per-station values for one file: the nearest grid point, or the element's
+    POINT_OPERATORS entry as one sparse product per field. Wind directions always use the
+    nearest point; stations outside the grid get NaN.
+    """
+    index = station_grid_index(context["station_df"], lats, lons, grid_id=grid_id, grid_keys=grid_keys)
+    iy, ix = index["iy"], index["ix"]
+    operator = config.POINT_OPERATORS.get(context["element"], "nearest")
+    point_operator = None
+    if operator != "nearest" and shape is not None:
+        point_operator = station_point_operator(context["station_df"], operator, shape, lats, lons,
+                                                grid_id=grid_id, grid_keys=grid_keys)
+
+    def point_values(values, name=""):
+        if point_operator is None or "dir" in name:
+            return mask_out_of_domain(values[..., iy, ix], index)
+        return mask_out_of_domain(point_operator.apply(values), index)
+    return point_values
+
+def _station_columns(valid_time, forecast_hour):
+    """Columns shared by every station of one file; the caller adds station_id."""
+    return {
+        "init_time": valid_time - pd.to_timedelta(forecast_hour, unit="h"),
+        "valid_time": valid_time,
+        "forecast_hour": forecast_hour,
+    }
+
+def extract_model_file(remote_url, payload, context):
+    """
+    Decode one downloaded model file and gather every station from it.
+
+    payload is a subset file path or a list of in-memory GRIB messages; context holds
+    model, element, rename_map, conversion_map, probabilistic and station_df.
+
+    Returns:
+    - dict — column name → per-station array (or per-file scalar), without station_id;
+      None when nothing was extracted
+    """
+    if context["probabilistic"]:
+        return _extract_probabilistic_file(remote_url, payload, context)
+    return _extract_deterministic_file(remote_url, payload, context)
+
+_decode_worker_context = None
+
+def init_decode_worker(context, settings, grid_indices, geometry):
+    """
+    ProcessPoolExecutor initializer for the model decode stage.
+
+    Spawned workers re-import archiver_config, so the parent's runtime settings are
+    applied again; station grid indices arrive once per worker and grid geometry is
+    mapped from shared memory instead of travelling with every task.
+    """
+    global _decode_worker_context
+    for name, value in settings.items():
+        setattr(config, name, value)
+    with _grid_index_lock:
+        _grid_index_memo.update(grid_indices)
+    attach_grid_geometry(geometry)
+    _decode_worker_context = context
+
+def decode_worker_extract(remote_url, payload):
+    """Decode worker task: extract_model_file with the context from init_decode_worker."""
+    return extract_model_file(remote_url, payload, _decode_worker_context)
+
+def decode_worker_count():
+    """DECODE_WORKERS, or every core this process may run on when unset."""
+    if config.DECODE_WORKERS:
+        return max(1, int(config.DECODE_WORKERS))
+    if hasattr(os, "sched_getaffinity"):
+        return max(1, len(os.sched_getaffinity(0)))
+    return os.cpu_count() or 1
+
+
+def _extract_deterministic_file(remote_url, payload, context):
+    model, element = context["model"], context["element"]
+    rename_map, conversion_map = context["rename_map"], context["conversion_map"]
+    local_file = payload if isinstance(payload, str) else os.path.basename(remote_url)
+    print(f"Now processing {local_file}...")
+    try:
+        # URMA files hold more than the 10 m fields; every other model is opened unfiltered
+        filter_keys = None if model in ("nbm", "hrrr", "nbm_exp") else URMA_FILTER_KEYS
+        if config.GRIB_READER == "eccodes" or not isinstance(payload, str):
+            grib = read_grib_fields(payload, filter_keys=filter_keys)
+            if grib is None:
+                raise ValueError("no GRIB messages matched")
+        else:
+            if model == "nbm":
+                ds = xr.open_dataset(
+                    local_file,
+                    engine="cfgrib",
+                    backend_kwargs={
+                        "indexpath": "",
+                        "errors": "ignore",
+                        "read_keys": list(GRID_DEFINITION_KEYS)
+                        },
+                    decode_timedelta=True,
+                )
+            elif model == "hrrr":
+                ds = xr.open_dataset(
+                    local_file,
+                    engine="cfgrib",
+                    backend_kwargs={
+                        "indexpath": "",
+                        "errors": "ignore",
+                        "read_keys": list(GRID_DEFINITION_KEYS)
+                        },
+                    decode_timedelta=True,
+                )
+            elif model == "nbm_exp":
+                ds = xr.open_dataset(
+                    local_file,
+                    engine="cfgrib",
+                    backend_kwargs={
+                        "indexpath": "",
+                        "errors": "ignore",
+                        "read_keys": list(GRID_DEFINITION_KEYS)
+                        },
+                    decode_timedelta=True,
+                )
+            else:
+                print(f"Model is {model} so will use cfgrib with keys: typeOfLevel:heightAboveGround, stepType: instant, level:10.  This may need to change if using different field or model that is not URMA")
+                ds = xr.open_dataset(
+                    local_file,
+                    engine="cfgrib",
+                    backend_kwargs={
+                        "filter_by_keys": URMA_FILTER_KEYS,
+                        "indexpath": "",
+                        "errors": "ignore",
+                        "read_keys": list(GRID_DEFINITION_KEYS)
+                    },
+                    decode_timedelta=True
+                )
+            grib = grib_fields_from_dataset(ds)
+        fields = grib["fields"]
+        grid_id = grib["grid_id"]
+        lats, lons = grib["lats"], grib["lons"]
+        #print(f"We are looking at other lons...")
+        #print(f"Lons are: {lons[150,150]}")
+        #tree, grid_shape = build_kdtree(lats, lons)
+        valid_time = pd.to_datetime(grib["valid_time"])
+        if model == 'nbm':
+            forecast_hour = int(re.search(r"\.f(\d{3})\.", os.path.basename(local_file)).group(1))
+        elif model == 'nbm_exp':
+            forecast_hour = int(re.search(r"\.f(\d{3})\.", os.path.basename(local_file)).group(1))
+        elif model == 'hrrr':
+            match = re.search(r"f(\d{2,3})", os.path.basename(local_file))
+            if match:
+                forecast_hour = int(match.group(1))
+            else:
+                raise ValueError(f"Could not extract forecast hour from {local_file}")
+        elif model == 'urma':
+            forecast_hour = 0
+        else:
+            print(f'File pattern matching not yet set up for {model}')
+            raise NotImplementedError
+
+        # every station in one fancy-indexing gather per variable
+        point_values = _station_extractor(context, lats, lons, grid_id, grib["grid_keys"], lats.shape)
+        columns = _station_columns(valid_time, forecast_hour)
+        if model == 'nbm' or model == 'urma' or model == "nbm_exp":
+            for grib_var, renamed_var in rename_map.items():
+                if grib_var not in fields:
+                    continue
+                vals = point_values(fields[grib_var], renamed_var)
+                factor = conversion_map.get(renamed_var, 1.0)
+                if "deg" in renamed_var:
+                    columns[renamed_var] = np.round(vals.astype(float), 0)
+                else:
+                    columns[renamed_var] = np.round((vals * factor).astype(float), 2)
+
+            return columns
+
+        elif model == 'hrrr':
+            if element == "Wind":
+                u = v = None  # Default to None in case either component is missing
+
+                for grib_var, renamed_var in rename_map.items():
+                    if grib_var not in fields:
+                        continue
+                    vals = point_values(fields[grib_var], renamed_var) * conversion_map.get(renamed_var, 1.0)
+
+                    if renamed_var == "u_wind":
+                        u = vals
+                    elif renamed_var == "v_wind":
+                        v = vals
+                    else:
+                        columns[renamed_var] = np.round(vals.astype(float), 2)
+
+                # If both u and v exist, compute speed and direction (NaN where either is missing)
+                if u is not None and v is not None:
+                    speed = np.sqrt(u**2 + v**2)
+                    direction = (270 - np.degrees(np.arctan2(v, u))) % 360
+                    columns["wind_dir_deg"] = np.round(direction.astype(float), 0)
+                    columns["wind_speed_kt"] = np.round(speed.astype(float), 2)
+
+                return columns
+            elif element == 'precip6hr':
+                for grib_var, renamed_var in rename_map.items():
+                    if grib_var not in fields:
+                        continue
+                    columns[renamed_var] = np.round(MM_to_IN(point_values(fields[grib_var], renamed_var)).astype(float), 2)
+
+                return columns
+            elif element == 'snow6hr':
+                for grib_var, renamed_var in rename_map.items():
+                    if grib_var not in fields:
+                        continue
+                    columns[renamed_var] = np.round(M_to_IN(point_values(fields[grib_var], renamed_var)).astype(float), 1)
+
+                return columns
+    except Exception as e:
+        print(f"❌ Failed to process {local_file}: {e}")
+
+
+def _extract_probabilistic_file(remote_url, payload, context):
+    model, element = context["model"], context["element"]
+    conversion_map = context["conversion_map"]
+    local_file = payload if isinstance(payload, str) else os.path.basename(remote_url)
+    print(f"Now processing {local_file}...")
+
+    try:
+        if model in ['nbmqmd', 'nbmqmd_exp', 'nbm', 'nbm_exp']:
+            forecast_hour = int(re.search(r"\.f(\d{3})\.", os.path.basename(local_file)).group(1))
+
+            grib_fields = {}
+            valid_time = None
+            lats, lons = None, None
+            grid_keys = None
+
+            with open_pygrib_messages(payload) as grbs:
+                for i, g in enumerate(grbs):
+                    # Grid definition from the first record; lat/lon only when the
+                    # projection lookup cannot place stations from it
+                    if grid_keys is None:
+                        grid_keys = grid_keys_from_message(g)
+                        needs_latlons = (config.GRID_LOOKUP != "projection"
+                                         or grid_projection(grid_keys) is None)
+                    if needs_latlons and (lats is None or lons is None):
+                        try:
+                            lats, lons = grid_geometry(grid_keys.get("md5Section3"), g.latlons,
+                                                       layout="pygrib")
+                        except Exception:
+                            pass  # Some messages might not support latlons()
+
+                    # Find first validDate
+                    if valid_time is None and hasattr(g, "validDate"):
+                        valid_time = pd.to_datetime(g.validDate)
+
+                    # Cache percentile fields
+                    if hasattr(g, "percentileValue"):
+                        grib_fields[int(g.percentileValue)] = g.values
+
+            if valid_time is None:
+                raise ValueError(f"No validDate found in {local_file}")
+
+            # Process all stations: one gather per percentile field
+            shape = next(iter(grib_fields.values())).shape if grib_fields else None
+            point_values = _station_extractor(context, lats, lons, None, grid_keys, shape)
+            columns = _station_columns(valid_time, forecast_hour)
+
+            for perc, values in grib_fields.items():
+                vals = point_values(values)
+                if element == "precip24hr":
+                    name, vals, digits = f"qpf_p{perc}", vals * conversion_map[element], 2
+                elif element == "precip6hr":
+                    name, vals, digits = f"qpf_p{perc}", vals * conversion_map[element], 2
+                elif element == "maxt":
+                    name, vals, digits = f"maxt_p{perc}", K_to_F(vals), 2
+                elif element == "mint":
+                    name, vals, digits = f"mint_p{perc}", K_to_F(vals), 2
+                elif element == "Wind":
+                    name, vals, digits = f"wind_p{perc}", MS_to_KTS(vals), 2
+                elif element == "Gust":
+                    name, vals, digits = f"gust_p{perc}", MS_to_KTS(vals), 2
+                elif element.startswith("snow"):
+                    name, vals, digits = f"snow_p{perc}", M_to_IN(vals), 1
+                else:
+                    raise NotImplementedError(
+                        f"Unit conversions not set up for {element} in {model}. "
+                        f"Check HERBIE_UNIT_CONVERSIONS in archiver_config.py"
+                    )
+                # pygrib hands back masked arrays where the bitmap is missing
+                columns[name] = np.round(np.ma.filled(np.ma.asarray(vals, dtype=float), np.nan), digits)
+
+            # Free memory
+            del grib_fields
+            gc.collect()
+            return columns
+
+        else:
+            raise NotImplementedError(f"Probabilistic file processing not yet set up for {model}")
+
+    except Exception as e:
+        print(f"❌ Failed to process {local_file}: {e}")
+
+
+def extract_model_subset_parallel(file_urls, station_df, search_strings, element, model, config,
+                                  return_counts=False):
+    """
+    Download, decode and extract every model file for the stations.
+
+    Returns:
+    - pd.DataFrame
+    - (pd.DataFrame, dict) if return_counts — plus file url -> rows, for files that produced rows
+    """
     rename_map = config.HERBIE_RENAME_MAP[element][model]
     conversion_map = config.HERBIE_UNIT_CONVERSIONS[element].get(model, {})
     print(f"Conversion map is: {conversion_map}")
@@ -804,24 +2529,34 @@ def extract_model_subset_parallel(file_urls, station_df, search_strings, element
     temp_download_dir = tempfile.mkdtemp(prefix="model_downloads_")
     print(f"📁 Using temp folder: {temp_download_dir}")
 
-    def download_file(remote_url):
+    # in-memory mode hands the matched messages straight to the decoder
+    in_memory = config.IN_MEMORY_DECODE
+
+    def local_path(remote_url):
         remote_file = os.path.basename(remote_url)
         date_tag, time_tag = parse_date_and_time_from_url(remote_url, model)
         #print(f"Date tag is: {date_tag} and time tag is {time_tag}")
-        local_file = os.path.join(temp_download_dir, f"{date_tag}_{time_tag}_{remote_file}")  # or whatever your directory is
+        return os.path.join(temp_download_dir, f"{date_tag}_{time_tag}_{remote_file}")  # or whatever your directory is
+
+    def download_file(remote_url):
+        local_file = local_path(remote_url)
         if model == 'urma':
-            try:
-                r = requests.get(remote_url)
-                if r.status_code in (200, 206):
-                    with open(local_file, 'wb') as f:
-                        f.write(r.content)
-                    return (remote_url, local_file)
-                else:
-                    print(f"❌ Failed to download URMA file: {remote_url}")
-                    return (remote_url, None)
-            except Exception as e:
-                print(f"❌ Exception downloading URMA file: {e}")
-                return (remote_url, None)
+            downloaded_file = download_subset(
+                remote_url=remote_url,
+                local_filename=local_file,
+                search_strings=search_strings,
+                model=model,
+                element=element,
+                require_all_matches=True,
+                exclude_phrases=config.HERBIE_EXCLUDE_PHRASES[element][model],
+                in_memory=in_memory,
+            )
+            if downloaded_file is None and config.URMA_FULL_FILE_FALLBACK:
+                print(f"⚠️ No usable .idx subset for {os.path.basename(remote_url)}, downloading the whole file")
+                downloaded_file = stream_download(remote_url, local_file)
+            if downloaded_file is None:
+                print(f"❌ Failed to download URMA file: {remote_url}")
+            return (remote_url, downloaded_file)
         elif model == 'nbmqmd':
             downloaded_file = download_subset(
                 remote_url=remote_url,
@@ -832,6 +2567,7 @@ def extract_model_subset_parallel(file_urls, station_df, search_strings, element
                 require_all_matches=True,
                 #required_phrases=config.HERBIE_REQUIRED_PHRASES[element][model],
                 #exclude_phrases=config.HERBIE_EXCLUDE_PHRASES[element][model],
+                in_memory=in_memory,
             )
             return (remote_url, downloaded_file)
         elif model == 'nbmqmd_exp':
@@ -844,6 +2580,7 @@ def extract_model_subset_parallel(file_urls, station_df, search_strings, element
                 require_all_matches=True,
                 #required_phrases=config.HERBIE_REQUIRED_PHRASES[element][model],
                 #exclude_phrases=config.HERBIE_EXCLUDE_PHRASES[element][model],
+                in_memory=in_memory,
             )
             return (remote_url, downloaded_file)
         else:          
@@ -856,264 +2593,161 @@ def extract_model_subset_parallel(file_urls, station_df, search_strings, element
                 require_all_matches=True,
                 required_phrases=config.HERBIE_REQUIRED_PHRASES[element][model],
                 exclude_phrases=config.HERBIE_EXCLUDE_PHRASES[element][model],
+                in_memory=in_memory,
             )
             return (remote_url, downloaded_file)
 
-    print("📥 Starting parallel downloads...")
-    with ThreadPoolExecutor(max_workers=config.MAX_WORKERS) as executor:
-        futures = [executor.submit(download_file, url) for url in file_urls]
-        downloaded_files = []
-        for i, future in enumerate(as_completed(futures), 1):
-            remote_url, local_file = future.result()
-            if local_file:
-                downloaded_files.append(local_file)
-            print(f"✅ Downloaded {i}/{len(file_urls)} files.")
-
-    print(f"📂 {len(downloaded_files)} files downloaded. Now starting data extraction...")
-
-    # Stage 2: Process each file (could also be parallel if needed, but safe to do serially)
-    station_index_cache = {}  # move it here so it's scoped properly
-    all_records = []
+    async def download_file_async(dl, remote_url):
+        local_file = local_path(remote_url)
+        if model in ['nbmqmd', 'nbmqmd_exp']:
+            exclude_phrases = None
+        else:
+            exclude_phrases = config.HERBIE_EXCLUDE_PHRASES[element][model]
+        downloaded_file = await dl.download_subset(
+            remote_url=remote_url,
+            local_filename=local_file,
+            search_strings=search_strings,
+            model=model,
+            element=element,
+            require_all_matches=True,
+            exclude_phrases=exclude_phrases,
+            in_memory=in_memory,
+        )
+        if model == 'urma':
+            if downloaded_file is None and config.URMA_FULL_FILE_FALLBACK:
+                print(f"⚠️ No usable .idx subset for {os.path.basename(remote_url)}, downloading the whole file")
+                downloaded_file = await dl.stream_download(remote_url, local_file)
+            if downloaded_file is None:
+                print(f"❌ Failed to download URMA file: {remote_url}")
+        return (remote_url, downloaded_file)
+
+    # Stage 2: decode + extract, in-process or in decode worker processes (extract_model_file)
     # probabilistic data is processed differently due to issues with cfgrib
-    if model not in  ['nbmqmd', 'nbmqmd_exp'] and element not in config.PROBABILISTIC_ELEMENTS[model]:
-        print(f"{element} not a probabilistic element for {model}")
-        for i, local_file in enumerate(downloaded_files):
-            print(f"Now processing {local_file}...")
-            try:
-                if model == "nbm":
-                    ds = xr.open_dataset(
-                        local_file,
-                        engine="cfgrib",
-                        backend_kwargs={
-                            "indexpath": "",
-                            "errors": "ignore"
-                            },
-                        decode_timedelta=True,
-                    )
-                elif model == "hrrr":
-                    ds = xr.open_dataset(
-                        local_file,
-                        engine="cfgrib",
-                        backend_kwargs={
-                            "indexpath": "",
-                            "errors": "ignore"
-                            },
-                        decode_timedelta=True,
-                    )
-                elif model == "nbm_exp":
-                    ds = xr.open_dataset(
-                        local_file,
-                        engine="cfgrib",
-                        backend_kwargs={
-                            "indexpath": "",
-                            "errors": "ignore"
-                            },
-                        decode_timedelta=True,
-                    )
-                else:
-                    print(f"Model is {model} so will use cfgrib with keys: typeOfLevel:heightAboveGround, stepType: instant, level:10.  This may need to change if using different field or model that is not URMA")
-                    ds = xr.open_dataset(
-                        local_file,
-                        engine="cfgrib",
-                        backend_kwargs={
-                            "filter_by_keys": {
-                                "typeOfLevel": "heightAboveGround",
-                                "stepType": "instant",
-                                "level": 10
-                            },
-                            "indexpath": "",
-                            "errors": "ignore"
-                        },
-                        decode_timedelta=True
-                    )
-                lats = ds.latitude.values
-                lons = ds.longitude.values  # wrap longitude
-                #print(f"We are looking at other lons...")
-                #print(f"Lons are: {lons[150,150]}")
-                #tree, grid_shape = build_kdtree(lats, lons)
-                valid_time = pd.to_datetime(ds.valid_time.values)
-                if model == 'nbm':
-                    forecast_hour = int(re.search(r"\.f(\d{3})\.", os.path.basename(local_file)).group(1))
-                elif model == 'nbm_exp':
-                    forecast_hour = int(re.search(r"\.f(\d{3})\.", os.path.basename(local_file)).group(1))
-                elif model == 'hrrr':
-                    match = re.search(r"f(\d{2,3})", os.path.basename(local_file))
-                    if match:
-                        forecast_hour = int(match.group(1))
-                    else:
-                        raise ValueError(f"Could not extract forecast hour from {local_file}")
-                elif model == 'urma':
-                    forecast_hour = 0
-                else:
-                    print(f'File pattern matching not yet set up for {model}')
-                    raise NotImplementedError
-
-                for _, row in station_df.iterrows():
-                    stid = row["stid"]
-                    lat, lon = row["latitude"], row["longitude"]
-
-                    if stid in station_index_cache:
-                            iy, ix = station_index_cache[stid]
-                    else:
-                        #iy, ix = query_kdtree(tree, grid_shape, lat, lon)
-                        iy, ix = ll_to_index(lat, lon, lats, lons)
-                        station_index_cache[stid] = (iy, ix)
-
-                    record = {
-                        "station_id": stid,
-                        "init_time": valid_time - pd.to_timedelta(forecast_hour, unit="h"),
-                        "valid_time": valid_time,
-                        "forecast_hour": forecast_hour,
-                    }
-                    if model == 'nbm' or model == 'urma' or model == "nbm_exp":
-                        for grib_var, renamed_var in rename_map.items():
-                            if grib_var not in ds:
-                                continue
-                            val = ds[grib_var].values[iy, ix]
-                            factor = conversion_map.get(renamed_var, 1.0)
-                            if pd.notnull(val):
-                                if "deg" in renamed_var:
-                                    record[renamed_var] = round(float(val), 0)
-                                else:
-                                    record[renamed_var] = round(float(val * factor), 2)
-
-                        all_records.append(record)
-
-                    elif model == 'hrrr':
-                        if element == "Wind":
-                            u = v = None  # Default to None in case either component is missing
-
-                            for grib_var, renamed_var in rename_map.items():
-                                if grib_var not in ds:
-                                    continue
-                                val = ds[grib_var].values[iy, ix]
-                                factor = conversion_map.get(renamed_var, 1.0)
-                                val = val * factor if pd.notnull(val) else None
-
-                                if renamed_var == "u_wind":
-                                    u = val
-                                elif renamed_var == "v_wind":
-                                    v = val
-                                else:
-                                    if val is not None:
-                                        record[renamed_var] = round(float(val), 2)
-
-                            # If both u and v exist, compute speed and direction
-                            if u is not None and v is not None:
-                                speed = np.sqrt(u**2 + v**2)
-                                direction = (270 - np.degrees(np.arctan2(v, u))) % 360
-                                record["wind_dir_deg"] = round(float(direction), 0)
-                                record["wind_speed_kt"] = round(float(speed), 2)
-
-                            all_records.append(record)  
-                        elif element == 'precip6hr':
-                            for grib_var, renamed_var in rename_map.items():
-                                if grib_var not in ds:
-                                    continue
-                                val = MM_to_IN(ds[grib_var].values[iy, ix])
-                                record[renamed_var] = round(float(val), 2)
-
-                            all_records.append(record)   
-                        elif element == 'snow6hr':
-                            for grib_var, renamed_var in rename_map.items():
-                                if grib_var not in ds:
-                                    continue
-                                val = M_to_IN(ds[grib_var].values[iy, ix])
-                                record[renamed_var] = round(float(val), 1)
-
-                            all_records.append(record)       
-            except Exception as e:
-                print(f"❌ Failed to process {local_file}: {e}")
-    # using pygrib to process nbmqmd files
-    # using pygrib to process nbmqmd files
-    else:
+    probabilistic = model in ['nbmqmd', 'nbmqmd_exp'] or element in config.PROBABILISTIC_ELEMENTS[model]
+    if probabilistic:
         print(f"{element} is probabilistic for {model} so handling accordingly")
-        for local_file in downloaded_files:
-            print(f"Now processing {local_file}...")
-
-            try:
-                if model in ['nbmqmd', 'nbmqmd_exp', 'nbm', 'nbm_exp']:
-                    forecast_hour = int(re.search(r"\.f(\d{3})\.", os.path.basename(local_file)).group(1))
-
-                    grib_fields = {}
-                    valid_time = None
-                    lats, lons = None, None
-
-                    with pygrib.open(local_file) as grbs:
-                        for i, g in enumerate(grbs):
-                            # Extract lat/lon from the first record
-                            if lats is None or lons is None:
-                                try:
-                                    lats, lons = g.latlons()
-                                except Exception:
-                                    pass  # Some messages might not support latlons()
-
-                            # Find first validDate
-                            if valid_time is None and hasattr(g, "validDate"):
-                                valid_time = pd.to_datetime(g.validDate)
-
-                            # Cache percentile fields
-                            if hasattr(g, "percentileValue"):
-                                grib_fields[int(g.percentileValue)] = g.values
-
-                    if valid_time is None:
-                        raise ValueError(f"No validDate found in {local_file}")
-
-                    # Process all stations
-                    for _, row in station_df.iterrows():
-                        stid = row["stid"]
-                        lat, lon = row["latitude"], row["longitude"]
-
-                        if stid in station_index_cache:
-                            iy, ix = station_index_cache[stid]
-                        else:
-                            iy, ix = ll_to_index(lat, lon, lats, lons)
-                            station_index_cache[stid] = (iy, ix)
-
-                        record = {
-                            "station_id": stid,
-                            "init_time": valid_time - pd.to_timedelta(forecast_hour, unit="h"),
-                            "valid_time": valid_time,
-                            "forecast_hour": forecast_hour,
-                        }
-
-                        for perc, values in grib_fields.items():
-                            if element == "precip24hr":
-                                record[f"qpf_p{perc}"] = round(float(values[iy, ix] * conversion_map[element]), 2)
-                            elif element == "precip6hr":
-                                record[f"qpf_p{perc}"] = round(float(values[iy, ix] * conversion_map[element]), 2)
-                            elif element == "maxt":
-                                record[f"maxt_p{perc}"] = round(float(K_to_F(values[iy, ix])), 2)
-                            elif element == "mint":
-                                record[f"mint_p{perc}"] = round(float(K_to_F(values[iy, ix])), 2)
-                            elif element == "Wind":
-                                record[f"wind_p{perc}"] = round(float(MS_to_KTS(values[iy, ix])), 2)
-                            elif element == "Gust":
-                                record[f"gust_p{perc}"] = round(float(MS_to_KTS(values[iy, ix])), 2)
-                            elif element.startswith("snow"):
-                                record[f"snow_p{perc}"] = round(float(M_to_IN(values[iy, ix])), 1)
-                            else:
-                                raise NotImplementedError(
-                                    f"Unit conversions not set up for {element} in {model}. "
-                                    f"Check HERBIE_UNIT_CONVERSIONS in archiver_config.py"
-                                )
-
-                        all_records.append(record)
-
-                else:
-                    raise NotImplementedError(f"Probabilistic file processing not yet set up for {model}")
-
-                # Free memory
-                gc.collect()
-
-            except Exception as e:
-                print(f"❌ Failed to process {local_file}: {e}")
-    # cleaning up
-    for local_file in downloaded_files:
-        Path(local_file).unlink(missing_ok=True)
-
+    else:
+        print(f"{element} not a probabilistic element for {model}")
+    context = {
+        "model": model,
+        "element": element,
+        "rename_map": rename_map,
+        "conversion_map": conversion_map,
+        "probabilistic": probabilistic,
+        "station_df": station_df,
+    }
+    frames = []
+    counts = {}
+    station_ids = station_df["stid"].to_numpy()
+
+    def collect(remote_url, columns):
+        if columns is not None:
+            frames.append(pd.DataFrame({"station_id": station_ids, **columns}))
+            counts[remote_url] = len(station_ids)
+
+    # Pipeline: downloads feed a bounded queue and this thread hands each file to the decode
+    # workers as soon as it lands, deleting it once extracted. Network and CPU overlap, and
+    # temp disk never holds more than the in-flight downloads, PIPELINE_QUEUE_SIZE queued
+    # files and two files per decode worker.
+    pending = queue.Queue(maxsize=config.PIPELINE_QUEUE_SIZE)
+    producer_errors = []
+
+    def download_and_queue(remote_url):
+        item = download_file(remote_url)
+        pending.put(item)
+        return item
+
+    async def download_and_queue_async(dl, remote_url):
+        item = await download_file_async(dl, remote_url)
+        # wait for queue space without stalling the event loop
+        await asyncio.to_thread(pending.put, item)
+        return item
+
+    def produce():
+        try:
+            if config.DOWNLOAD_ENGINE == "async":
+                print("📥 Starting async downloads...")
+                download_files_async(file_urls, download_and_queue_async, max_files=config.ASYNC_MAX_FILES)
+            else:
+                print("📥 Starting parallel downloads...")
+                with ThreadPoolExecutor(max_workers=config.MAX_WORKERS) as executor:
+                    futures = [executor.submit(download_and_queue, url) for url in file_urls]
+                    for i, future in enumerate(as_completed(futures), 1):
+                        future.result()
+                        print(f"✅ Downloaded {i}/{len(file_urls)} files.")
+        except Exception as e:
+            producer_errors.append(e)
+        finally:
+            pending.put(None)
+
+    def remove_payload(payload):
+        if isinstance(payload, str):
+            Path(payload).unlink(missing_ok=True)
+
+    decode_workers = decode_worker_count()
+    decode_pool = None
+    in_flight = {}
+
+    def finish(future):
+        remote_url, payload = in_flight.pop(future)
+        try:
+            collect(remote_url, future.result())
+        except Exception as e:
+            print(f"❌ Decode worker failed on {os.path.basename(remote_url)}: {e}")
+        finally:
+            remove_payload(payload)
+
+    producer = threading.Thread(target=produce, name="model-downloads", daemon=True)
+    producer.start()
+    n_extracted = 0
+    try:
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+            remote_url, payload = item
+            if not payload:
+                continue
+            n_extracted += 1
+            if decode_workers == 1 or n_extracted == 1:
+                # the first file is decoded here so the station grid index and grid geometry
+                # it builds are handed to the workers instead of rebuilt in each of them
+                try:
+                    collect(remote_url, extract_model_file(remote_url, payload, context))
+                finally:
+                    remove_payload(payload)
+                continue
+            if decode_pool is None:
+                print(f"🔧 Starting {decode_workers} decode workers")
+                # spawn, not fork: the download threads are running when the pool starts
+                decode_pool = ProcessPoolExecutor(
+                    max_workers=decode_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=init_decode_worker,
+                    initargs=(
+                        context,
+                        {name: value for name, value in vars(config).items() if name.isupper()},
+                        dict(_grid_index_memo),
+                        share_grid_geometry(),
+                    ),
+                )
+            while len(in_flight) >= 2 * decode_workers:
+                done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(future)
+            in_flight[decode_pool.submit(decode_worker_extract, remote_url, payload)] = (remote_url, payload)
+        for future in as_completed(list(in_flight)):
+            finish(future)
+    finally:
+        if decode_pool is not None:
+            decode_pool.shutdown(cancel_futures=True)
+        release_grid_geometry()
+    producer.join()
     shutil.rmtree(temp_download_dir)
-    df = pd.DataFrame.from_records(all_records)
+    if producer_errors:
+        raise producer_errors[0]
+    print(f"📂 Extracted {n_extracted}/{len(file_urls)} files.")
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
     # logic for creating accum intervals from total precip for models that output only tp
     if model == "hrrr" and element == "precip6hr":
         # Pick the cumulative column name produced by your rename_map
@@ -1133,6 +2767,8 @@ def extract_model_subset_parallel(file_urls, station_df, search_strings, element
                 df, total_col=total_col, out_col="snow_6h", hours=6,
                 group_cols=("station_id", "init_time")
             )
+    if return_counts:
+        return df, counts
     return df
 
 